@@ -1,6 +1,7 @@
 import datetime
 import hashlib
 import hmac
+import html
 import json
 import os
 import urllib.parse
@@ -8,27 +9,37 @@ from hashlib import sha256
 from threading import Thread
 
 import pytz
-import requests
 from flask import Flask, render_template, Response, send_from_directory, request, redirect, make_response
-from functools import lru_cache
-import time
 import dotenv
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import asset_manifest
+import avatars
 import blog
 import const
 import cors
+import fragments
+import http_client
+import images
 import comment_auth
+import compression
+import conditional
 import jammingen
+import precomputed
 import robots
+import search
 from blog import get_blog_posts
 from dino import dino_game
+from scheduler import Scheduler
 from helpers import get_discord_status, get_age, show_notification, \
-    format_iso_date, fishlogic, random_copyright_year, get_server_status, fetch_remote_image, generate_proxy_url, \
-    is_safe_url
+    fishlogic, random_copyright_year, get_server_status, fetch_remote_image, is_safe_url, discord_presence, \
+    discord_status_events
 from spotify import spotify_status_updater, event_reader, get_cover_bytes
 
 app = Flask(__name__, template_folder='pages')
+compression.init_app(app)
+http_client.init_app(app)
+app.add_template_global(asset_manifest.asset_url)
 if os.getenv("FLASK_DEBUG") != "1":
     app.wsgi_app = ProxyFix(app.wsgi_app)
 dotenv.load_dotenv()
@@ -52,7 +63,7 @@ def index():
     midnight = tz.localize(datetime.datetime(now.year, now.month, now.day, 0, 0, 0))
     return render_template(
         'index.html',
-        discord_status=discord_status,
+        discord_status=discord_presence.discord_status,
         discord_invite_url=const.DISCORD_INVITE,
         discord_server_info=discord_server_info,
         age=get_age(),
@@ -60,8 +71,7 @@ def index():
         blog=last_blog,
         is_tor=request.headers.get("Host", "").endswith(".onion"),
         const=const,
-        style_hash=style_hash,
-        pgp_key=pgp_key.decode("utf-8"),
+        pgp_key=pgp_key_text,
         day_seconds=int(now.timestamp() - midnight.timestamp()),
         tz=tz_string,
     )
@@ -70,8 +80,18 @@ def index():
 @app.route('/discord_status')
 @robots.noindex
 def discord_status_route():
+    if request.args.get("stream"):
+        # one long-lived response per page, updated whenever lanyard pushes a new status
+        resp = render_template("partials/discord_status.html", stream=True)
+        return discord_status_events(resp), 200, {
+            "Cache-Control": "no-cache",
+            "Content-Type": "text/html; charset=utf-8"
+        }
+
     refresh_every = request.args.get("refresh_every", 10)
-    return render_template("partials/discord_status.html", discord_status=discord_status, refresh_every=refresh_every)
+    return render_template(
+        "partials/discord_status.html", discord_status=discord_presence.discord_status, refresh_every=refresh_every
+    )
 
 
 @app.route('/blogs/')
@@ -91,7 +111,24 @@ def blogs_page(language=None):
         copyright=random_copyright_year(),
         lang=language,
         all_languages=blogs.languages,
-        style_hash=blog_style_hash,
+    )
+
+
+@app.route('/blog/search')
+@robots.noindex
+@robots.follow
+def blog_search():
+    query = request.args.get("q", "").strip()[:200]
+    language = request.args.get("lang", "en")
+    if language not in blogs.languages:
+        language = "en"
+    return render_template(
+        'blogs_list.html',
+        blogs=search.search(blogs, query, language) if query else (),
+        copyright=random_copyright_year(),
+        lang=language,
+        all_languages=blogs.languages,
+        query=query,
     )
 
 
@@ -109,24 +146,20 @@ def blog_post(url_name=None):
 
     user_data = comment_auth.get_user_data_from_request(request)
 
-    date_text = format_iso_date(blog_.date)
+    # only the comment section and the footer depend on the visitor, everything else comes from cached fragments
     resp = app.make_response(
         render_template(
             'blog_post.html',
             blog=blog_,
-            date_text=date_text,
             user_data=user_data,
             copyright=random_copyright_year(),
-            style_hash=blog_style_hash,
-            generate_proxy_url=generate_proxy_url,
-            xmr_address=const.XMR_DONATION_ADDRESS,
-            btc_address=const.BTC_DONATION_ADDRESS,
-            discord_status=discord_status,
-            discord_invite_url=const.DISCORD_INVITE,
-            discord_server_info=discord_server_info,
+            content_html=fragments.render_post_content(blog_, blogs.version),
+            discord_invite_html=fragments.render_discord_invite(discord_server_info),
+            comment_list_html=fragments.render_comment_list(blog_, user_data) if blog_.language == "en" else "",
         )
     )
-    if (blog_.original_url or blog_.url_name) == blogs.get_by_language("en")[0].url_name:
+    newest_blog = blogs.get_newest("en")
+    if newest_blog and (blog_.original_url or blog_.url_name) == newest_blog.url_name:
         resp.set_cookie(
             "last_read",
             (blog_.original_url or blog_.url_name),
@@ -168,12 +201,12 @@ def blog_post_short(blog_hash):
 @app.route('/blog/rss.xml')
 def rss():
     lang = request.args.get("lang", "en")
-    return Response(blog.get_rss(blogs, lang), mimetype="text/xml")
+    return blog.get_rss_response(blogs, lang)
 
 
 @app.route('/blog/news_sitemap.xml')
 def news_sitemap():
-    return Response(blog.get_news_sitemap(blogs), mimetype="text/xml")
+    return blog.get_news_sitemap_response(blogs)
 
 
 @app.route('/notification')
@@ -186,6 +219,7 @@ def notification():
 @app.route("/email.svg")
 @robots.noindex
 @robots.disallow
+@precomputed.constant
 def email_svg():
     return Response(
         render_template("partials/email.svg", email=const.EMAIL),
@@ -229,15 +263,14 @@ def github_callback():
 
 
 @app.route('/github/profile_image/<user_id>')
-@lru_cache(maxsize=30)
 @robots.noindex
 @robots.disallow
+@conditional.etag
 def github_profile_image(user_id):
-    req = requests.get(f"https://avatars.githubusercontent.com/u/{user_id}?v=4&s=100")
-    resp = make_response(req.content)
-    resp.headers["Content-Type"] = req.headers["Content-Type"]
-    resp.headers["Cache-Control"] = f"public, max-age={60 * 60 * 24}"
-    return resp
+    return avatars.send_avatar(
+        f"github/{user_id}",
+        lambda: fetch_remote_image(f"https://avatars.githubusercontent.com/u/{user_id}?v=4&s=100")
+    )
 
 
 @app.route('/github/login')
@@ -262,20 +295,15 @@ def discord_callback():
 
 
 @app.route('/discord/profile_image/<user_id>/<avatar_id>')
-@lru_cache(maxsize=30)
 @robots.noindex
 @robots.disallow
+@conditional.etag
 def discord_profile_image(user_id, avatar_id):
-    resp = make_response(send_from_directory("assets", "discord_default.png"))
-    resp.headers["Cache-Control"] = f"public, max-age={60 * 60 * 24}"
-    if avatar_id is None:
-        return resp
-    req = requests.get(f"https://cdn.discordapp.com/avatars/{user_id}/{avatar_id}.png?size=256")
-    if req.status_code == 200:
-        resp = make_response(req.content)
-        resp.headers["Content-Type"] = req.headers["Content-Type"]
-    resp.headers["Cache-Control"] = f"public, max-age={60 * 60 * 24}"
-    return resp
+    return avatars.send_avatar(
+        f"discord/{user_id}/{avatar_id}",
+        lambda: fetch_remote_image(f"https://cdn.discordapp.com/avatars/{user_id}/{avatar_id}.png?size=128"),
+        fallback="discord_default.png"
+    )
 
 
 @app.route('/mastodon/login', methods=["POST"])
@@ -301,6 +329,7 @@ def instance_not_found():
 @app.route('/mastodon/profile_image')
 @robots.noindex
 @robots.disallow
+@conditional.etag
 def mastodon_profile_image():
     image_url_param = request.args.get("url")
     signature_param = request.args.get("sig")
@@ -315,19 +344,12 @@ def mastodon_profile_image():
     ).hexdigest()
     if not hmac.compare_digest(expected_sig, signature_param):
         return "Invalid Signature", 403
-    target_url = image_url_param
-
-    image_data, content_type = fetch_remote_image(target_url)
-
-    if image_data is None:
-        resp = make_response(send_from_directory("assets", "mastodon.png"))
-        resp.headers["Cache-Control"] = "no-cache"
-        return resp
 
-    resp = make_response(image_data)
-    resp.headers["Content-Type"] = content_type or "image/png"
-    resp.headers["Cache-Control"] = f"public, max-age={60 * 60 * 24}"
-    return resp
+    return avatars.send_avatar(
+        f"mastodon/{image_url_param}",
+        lambda: fetch_remote_image(image_url_param),
+        fallback="mastodon.png"
+    )
 
 
 @app.route('/reddit/login')
@@ -346,27 +368,27 @@ def reddit_callback():
 @app.route('/reddit/profile_image/<user_id>')
 @robots.noindex
 @robots.disallow
+@conditional.etag
 def reddit_profile_image(user_id):
-    try:
-        req = requests.get(f"https://www.reddit.com/user/{user_id}/about.json", headers={
+    def fetch():
+        req = http_client.get(f"https://www.reddit.com/user/{user_id}/about.json", headers={
             "User-Agent": "lina's blog"
         })
-        if req.status_code == 200:
-            data = req.json()
-            if "icon_img" in data["data"]:
-                icon_url = data["data"]["icon_img"]
-                if icon_url:
-                    req = requests.get(icon_url)
-                    print(req.status_code)
-                    resp = make_response(req.content)
-                    resp.headers["Content-Type"] = req.headers["Content-Type"]
-                    resp.headers["Cache-Control"] = f"public, max-age={60 * 60 * 24}"
-                    return resp
-    except requests.RequestException:
-        pass
+        if req.status_code >= 500:
+            req.raise_for_status()
+        if req.status_code != 200:
+            return None, None
+        try:
+            icon_url = req.json().get("data", {}).get("icon_img")
+        except (json.JSONDecodeError, AttributeError):
+            return None, None
+        if not icon_url:
+            return None, None
+        # reddit html-escapes the query string of the icon url
+        return fetch_remote_image(html.unescape(icon_url))
+
     # If the request fails or the icon is not found, return a default image
-    resp = make_response(send_from_directory("assets", "reddit_default.png"))
-    return resp
+    return avatars.send_avatar(f"reddit/{user_id}", fetch, fallback="reddit_default.png")
 
 
 @app.route("/logout", methods=["POST"])
@@ -381,6 +403,7 @@ def logout():
 
 
 @app.route('/pgp')
+@precomputed.constant
 def pgp():
     resp = Response(pgp_key, mimetype="text/plain")
     resp.headers["Content-Disposition"] = "inline; filename=lina_public.asc"
@@ -389,17 +412,31 @@ def pgp():
 
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory("assets", "favicon.ico")
+    return compression.send_precompressed("assets", "favicon.ico")
 
 
 @app.route('/assets/<path:filename>')
 def banner(filename):
-    resp = make_response(send_from_directory("assets", filename))
-    if os.getenv("FLASK_DEBUG") != "1":
+    resp = make_response(compression.send_precompressed("assets", filename))
+    if os.getenv("FLASK_DEBUG") == "1":
+        return resp
+    # urls from asset_url() carry the content hash, so they can be cached until the file changes
+    if request.args.get("hash") and asset_manifest.is_current(filename, request.args.get("hash")):
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
         resp.headers["Cache-Control"] = "public, max-age=604800"
     return resp
 
 
+@app.route('/assets/variants/<filename>')
+@robots.noindex
+def image_variant(filename):
+    resp = make_response(send_from_directory(images.image_cache_directory, filename))
+    # variant names contain the hash of their source image, so they never change
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+
 @app.route('/assets/88x31/jammin.webp')
 @robots.disallow
 @robots.noindex
@@ -421,6 +458,7 @@ def redirect_new_button():
 
 @app.route('/assets/discord_icon.png')
 @robots.noindex
+@conditional.etag_from(lambda: discord_server_info.get("icon_hash"), cache_control="public, max-age=86400")
 def discord_icon():
     icon_bytes = discord_server_info.get("icon_bytes")
     if icon_bytes:
@@ -451,6 +489,7 @@ def security_txt(filename):
 
 @app.route('/.well-known/button.json')
 @cors.allow_origin("*")
+@precomputed.constant
 def button():
     return Response(json.dumps({
         "$schema": "https://codeberg.org/LunarEclipse/well-known-button/raw/branch/main/drafts/"
@@ -476,6 +515,7 @@ def parrot():
 
 @app.route('/spotify-cover.png')
 @robots.noindex
+@conditional.etag
 def spotify_image_proxy():
     spotify_cover_bytes = get_cover_bytes()
     if not spotify_cover_bytes:
@@ -488,6 +528,7 @@ def spotify_image_proxy():
 
 @app.route("/impressum")
 @robots.noindex
+@precomputed.constant
 def impressum():
     return render_template("impressum.html")
 
@@ -522,28 +563,90 @@ def after_request(response):
     return response
 
 
-discord_status = ""
 discord_server_info = {}
 
+compression.precompress_directory("assets")
+# before the posts are rendered, they link their images by hash
+asset_manifest.build_manifest("assets")
+
 blogs = get_blog_posts()
+search.update_indexes(blogs)
 
-style_hash = sha256(open("assets/style.css", "rb").read()).hexdigest()[:8]
-blog_style_hash = sha256(open("assets/blog.css", "rb").read()).hexdigest()[:8]
 button_hash = sha256(open("assets/88x31/lina.gif", "rb").read()).hexdigest()
 pgp_key = open('pgp', 'rb').read()
+pgp_key_text = pgp_key.decode("utf-8")
+precomputed.render_constant_responses(app)
 
 
-def stats_updater():
-    global discord_status, discord_server_info
-    while True:
-        discord_status = get_discord_status()
-        discord_server_info = get_server_status()
-        time.sleep(30)
+def reload_blogs():
+    try:
+        if not blog.reload_blog_posts(blogs):
+            return False
+    except (OSError, ValueError, TypeError) as e:
+        # most likely a post that is still being written, the old version is served and the scheduler backs off
+        print(f"Failed to reload blog posts: {e}")
+        raise
+    robots.update_sitemaps(app, blogs)
+    search.update_indexes(blogs)
+    print(f"Reloaded blog posts, now serving {len(blogs)} posts")
+    return True
+
+
+def refresh_discord_status():
+    # lanyard pushes every change over the websocket, polling is only the fallback while that is down
+    if discord_presence.connected:
+        return False
+    status = get_discord_status()
+    if status is None:
+        # hides the status until lanyard answers again
+        discord_presence.update(None)
+        raise ConnectionError("Lanyard did not answer")
+    return discord_presence.update({"discord_status": status})
+
+
+def refresh_server_status():
+    global discord_server_info
+    server_info = get_server_status(discord_server_info)
+    if not server_info:
+        raise ConnectionError("Discord did not answer")
+    if server_info == discord_server_info:
+        return False
+    discord_server_info = server_info
+    return True
+
+
+def refresh_assets():
+    # edited assets get new compressed siblings and a new hash without a restart
+    written = compression.precompress_directory("assets")
+    changed = asset_manifest.refresh_manifest("assets")
+    if changed:
+        print(f"Re-hashed {len(changed)} changed assets")
+    return bool(written or changed)
+
+
+def log_task_stats():
+    # the scheduler only prints single failures, this shows how the tasks are doing over time
+    for name, stats in background_tasks.get_stats().items():
+        if name == "task_stats" or not stats["runs"]:
+            continue
+        print(
+            f"Task {name}: {stats['runs']} runs, {stats['changes']} changes, {stats['failures']} failures "
+            f"({stats['consecutive_failures']} in a row), last error: {stats['last_error']}"
+        )
+    return False
 
 
 robots.robot_friendly(app, blogs, extra_sitemaps=["blog/rss.xml", "blog/news_sitemap.xml"])
 
+background_tasks = Scheduler()
+background_tasks.add("discord_status", refresh_discord_status, interval=30)
+background_tasks.add("discord_server", refresh_server_status, interval=60)
+background_tasks.add("blog_watcher", reload_blogs, interval=5)
+background_tasks.add("assets", refresh_assets, interval=10)
+background_tasks.add("task_stats", log_task_stats, interval=60 * 60)
+
 # Check if Flask is in debug mode
 if os.environ.get("FLASK_DEBUG") != "1":
     Thread(target=spotify_status_updater, daemon=True).start()
-    Thread(target=stats_updater, daemon=True).start()
+    discord_presence.start()
+    background_tasks.start()
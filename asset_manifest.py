@@ -0,0 +1,101 @@
+import hashlib
+import os
+
+__all__ = [
+    "build_manifest", "refresh_manifest", "get_manifest", "load_manifest", "get_hash", "is_current", "asset_url",
+    "fingerprint_url", "assets_directory",
+]
+
+assets_directory = 'assets'
+
+# precompressed siblings are served in place of their source file and never linked directly
+SKIPPED_SUFFIXES = (".br", ".gz", ".tmp")
+
+
+def _hash_file(path: str) -> (int, int, str):
+    # (mtime, size, hash), the stamp tells whether the hash is still valid
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        return stat.st_mtime_ns, stat.st_size, hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def _walk(directory: str):
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith(SKIPPED_SUFFIXES):
+                continue
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, directory).replace(os.sep, "/"), path
+
+
+def build_manifest(directory: str = assets_directory):
+    global _manifest
+    _manifest = {name: _hash_file(path) for name, path in _walk(directory)}
+
+
+def refresh_manifest(directory: str = assets_directory) -> [str]:
+    # runs as a background task, so lookups stay plain dict reads. only files whose mtime or size changed are
+    # hashed again, returns the names that were added, changed or removed
+    global _manifest
+    manifest = {}
+    changed = []
+    for name, path in _walk(directory):
+        try:
+            stat = os.stat(path)
+            entry = _manifest.get(name)
+            if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+                entry = _hash_file(path)
+                changed.append(name)
+        except OSError:
+            continue
+        manifest[name] = entry
+    changed.extend(_manifest.keys() - manifest.keys())
+    # swapped in as a whole, readers never see a half-updated manifest
+    _manifest = manifest
+    return changed
+
+
+def get_manifest() -> {str: (int, int, str)}:
+    return _manifest
+
+
+def load_manifest(manifest: {str: (int, int, str)}):
+    # for the render workers, which link assets but never walk the directory themselves
+    global _manifest
+    _manifest = manifest
+
+
+def get_hash(filename: str) -> str | None:
+    # called for every asset link on every page, so this must not touch the disk
+    entry = _manifest.get(filename)
+    return None if entry is None else entry[2]
+
+
+def is_current(filename: str, file_hash: str) -> bool:
+    # whether the file on disk still has this hash. the asset route checks this before marking a response
+    # immutable, a file edited since the last refresh must not be cached under its old hash
+    entry = _manifest.get(filename)
+    if entry is None or entry[2] != file_hash:
+        return False
+    try:
+        stat = os.stat(os.path.join(assets_directory, filename))
+    except OSError:
+        return False
+    return entry[:2] == (stat.st_mtime_ns, stat.st_size)
+
+
+def asset_url(filename: str) -> str:
+    file_hash = get_hash(filename)
+    if file_hash is None:
+        return f"/assets/{filename}"
+    return f"/assets/{filename}?hash={file_hash}"
+
+
+def fingerprint_url(url: str) -> str:
+    # same as asset_url, but for full /assets/... urls like the ones in blog posts
+    if not url.startswith("/assets/") or "?" in url or "#" in url:
+        return url
+    return asset_url(url[len("/assets/"):])
+
+
+_manifest: {str: (int, int, str)} = {}
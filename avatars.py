@@ -0,0 +1,238 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import requests
+from flask import make_response, send_from_directory
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import http_client
+from singleflight import SingleFlight
+
+__all__ = ["Avatar", "AvatarCache", "get_avatar", "send_avatar", "avatar_cache_directory"]
+
+avatar_cache_directory = os.path.join('cache', 'avatars')
+
+# profile images are small, this keeps a few thousand of them
+MAX_BYTES = 64 * 1024 * 1024
+AVATAR_TTL = 60 * 60 * 24
+# users without a profile image (or deleted accounts) are asked again after this
+MISSING_TTL = 60 * 60
+BROWSER_MAX_AGE = 60 * 60 * 24
+# a fallback image stands in for an avatar that may show up any moment, or an upstream that is only down for now
+FALLBACK_MAX_AGE = 60 * 5
+
+# comments show avatars at 50x50, this covers 2x screens
+THUMBNAIL_SIZE = 100
+THUMBNAIL_OPTIONS = {"quality": 80, "method": 6}
+# bump this whenever _make_thumbnail changes its output, so old thumbnails are not served anymore
+THUMBNAIL_VERSION = 1
+# what pillow raises for bodies that are not (complete) images, some decoders raise SyntaxError or EOFError
+DECODE_ERRORS = (UnidentifiedImageError, OSError, ValueError, SyntaxError, EOFError, Image.DecompressionBombError)
+
+
+@dataclass(frozen=True)
+class Avatar:
+    data: bytes
+    content_type: str
+    etag: str
+
+
+@dataclass
+class _Entry:
+    size: int
+    expires: float
+    # both None for a cached miss
+    content_type: str | None
+    etag: str | None
+
+
+class AvatarCache:
+    # images live in <directory>/<name>.img next to a <name>.json with their metadata, the in-memory index only
+    # holds the metadata and is rebuilt from the json files on startup
+    def __init__(self, directory: str, max_bytes: int, ttl: float, missing_ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._total_bytes = 0
+        self._load()
+
+    @staticmethod
+    def _get_name(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, name: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            return
+        loaded = []
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            name = filename[:-len(".json")]
+            try:
+                with open(self._path(name, "json"), encoding="utf-8") as f:
+                    entry = _Entry(**json.load(f))
+                last_used = os.path.getmtime(self._path(name, "json"))
+                if entry.content_type is not None and os.path.getsize(self._path(name, "img")) != entry.size:
+                    raise ValueError("image does not match its metadata")
+            except (OSError, ValueError, TypeError):
+                self._remove_files(name)
+                continue
+            if entry.expires <= now:
+                self._remove_files(name)
+                continue
+            loaded.append((last_used, name, entry))
+
+        for _, name, entry in sorted(loaded, key=lambda item: item[0]):
+            self._entries[name] = entry
+            self._total_bytes += entry.size
+        with self._lock:
+            self._evict()
+
+    def _remove_files(self, name: str):
+        for extension in ("json", "img"):
+            try:
+                os.remove(self._path(name, extension))
+            except OSError:
+                pass
+
+    def _drop(self, name: str):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._total_bytes -= entry.size
+            self._remove_files(name)
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+
+    def _read(self, name: str) -> (bool, Avatar | None):
+        # (found, avatar), a cached miss is (True, None)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+            if entry.expires <= time.time():
+                self._drop(name)
+                return False, None
+            self._entries.move_to_end(name)
+        if entry.content_type is None:
+            return True, None
+        try:
+            with open(self._path(name, "img"), "rb") as f:
+                return True, Avatar(f.read(), entry.content_type, entry.etag)
+        except OSError:
+            # evicted by another thread in the meantime
+            return False, None
+
+    def _write(self, name: str, data: bytes | None, content_type: str | None):
+        if data is None:
+            entry = _Entry(0, time.time() + self.missing_ttl, None, None)
+        else:
+            entry = _Entry(len(data), time.time() + self.ttl, content_type, hashlib.sha256(data).hexdigest()[:32])
+            if entry.size > self.max_bytes:
+                return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+            if data is not None:
+                with open(f"{self._path(name, 'img')}.{temp_suffix}", "wb") as f:
+                    f.write(data)
+                os.replace(f"{self._path(name, 'img')}.{temp_suffix}", self._path(name, "img"))
+            with open(f"{self._path(name, 'json')}.{temp_suffix}", "w", encoding="utf-8") as f:
+                json.dump(entry.__dict__, f)
+            os.replace(f"{self._path(name, 'json')}.{temp_suffix}", self._path(name, "json"))
+        except OSError as e:
+            print(f"Failed to write avatar cache entry {name}: {e}")
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(name, None)
+            if old_entry is not None:
+                self._total_bytes -= old_entry.size
+            self._entries[name] = entry
+            self._total_bytes += entry.size
+            self._evict()
+
+    def get(self, key: str, fetch) -> Avatar | None:
+        # fetch returns (bytes, content_type), or (None, None) if the user has no image, which is cached as well.
+        # failures are raised as requests.RequestException by fetch and are not cached
+        name = self._get_name(key)
+        found, avatar = self._read(name)
+        if found:
+            return avatar
+
+        data, content_type = fetch()
+        self._write(name, data, content_type)
+        if data is None:
+            return None
+        return Avatar(data, content_type, hashlib.sha256(data).hexdigest()[:32])
+
+
+def _make_thumbnail(data: bytes | None, content_type: str | None) -> (bytes | None, str | None):
+    # upstreams hand out anything from tiny pngs to multi-megabyte originals, every avatar is stored as a small webp
+    if data is None:
+        return None, None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # lets jpeg decode at a fraction of the size instead of scaling down the full image afterwards
+            image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            # animated avatars only keep their first frame
+            thumbnail = image.convert("RGBA")
+        thumbnail = ImageOps.fit(thumbnail, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        thumbnail.save(output, format="WEBP", **THUMBNAIL_OPTIONS)
+    except DECODE_ERRORS as e:
+        # cached like a user without an image, so a broken upstream body is not decoded again on every request
+        print(f"Failed to decode avatar ({content_type}): {e}")
+        return None, None
+    return output.getvalue(), "image/webp"
+
+
+def get_avatar(key: str, fetch) -> Avatar | None:
+    # a popular commenter means many concurrent misses for the same avatar, only one of them fetches it
+    key = f"{key}\0{THUMBNAIL_SIZE}\0{THUMBNAIL_VERSION}"
+    try:
+        return _fetches.do(
+            key, lambda: _cache.get(key, lambda: _make_thumbnail(*fetch())), timeout=http_client.time_left()
+        )
+    except TimeoutError:
+        raise http_client.DeadlineExceeded(f"No time left waiting for avatar {key!r}")
+
+
+def send_avatar(key: str, fetch, fallback: str = None):
+    # the cached avatar with an etag, or the fallback image from assets/ if there is none
+    try:
+        avatar = get_avatar(key, fetch)
+    except (requests.RequestException, *DECODE_ERRORS) as e:
+        print(f"Failed to fetch avatar {key}: {e}")
+        avatar = None
+
+    if avatar is None:
+        if fallback is None:
+            return "Profile image not found", 404
+        resp = make_response(send_from_directory("assets", fallback))
+        resp.headers["Cache-Control"] = f"public, max-age={FALLBACK_MAX_AGE}"
+        return resp
+
+    resp = make_response(avatar.data)
+    resp.headers["Content-Type"] = avatar.content_type
+    resp.headers["Cache-Control"] = f"public, max-age={BROWSER_MAX_AGE}"
+    resp.set_etag(avatar.etag)
+    return resp
+
+
+_cache = AvatarCache(avatar_cache_directory, max_bytes=MAX_BYTES, ttl=AVATAR_TTL, missing_ttl=MISSING_TTL)
+_fetches = SingleFlight()
@@ -1,19 +1,38 @@
 import hashlib
 import html
-import json
+import itertools
 import os
 import base64
+import bisect
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 from multiprocessing import Lock
 
 import markdown
-import bs4
 
 import helpers
+from blog_render import get_file_stamp, load_cached_render, render_all, render_markdown
+from comment_store import CommentStore
+from precomputed import PrecomputedResponse
 from comment_auth import get_user_data_from_request
 
 blog_directory = 'blog_posts'
+comments_database = os.path.join(blog_directory, 'comments.sqlite3')
+
+_comment_store: CommentStore | None = None
+# shared by all posts, a reloaded post is a new object and must not reuse the versions of the one it replaces,
+# or fragments cached for the old one would match again
+_comments_versions = itertools.count(1)
+_comment_store_lock = Lock()
+
+
+def get_comment_store() -> CommentStore:
+    global _comment_store
+    # opened lazily, nothing needs the database before the first comment is shown
+    with _comment_store_lock:
+        if _comment_store is None:
+            _comment_store = CommentStore(comments_database, legacy_directory=os.path.join(blog_directory, 'comments'))
+    return _comment_store
 
 
 class BlogPost:
@@ -29,7 +48,8 @@ class BlogPost:
             co_authors: str = None,
             language: str = "en",
             original_url: str = None,
-            vgwort: str = None
+            vgwort: str = None,
+            content_html: str = None
     ):
         if not title or not summary or not date or not content:
             raise ValueError("Missing required fields")
@@ -40,7 +60,7 @@ class BlogPost:
         self.image = image
         self.hash = hash or self._get_hash()
         self._content_md = content
-        self.content = self._render_markdown()
+        self.content = content_html or load_cached_render(content) or render_markdown(content)
         self.language = language
         self.vgwort = vgwort
         self.original_url = original_url
@@ -50,12 +70,12 @@ class BlogPost:
         if co_authors:
             self.co_authors = [markdown.markdown(author.strip()) for author in co_authors.split(",")]
 
-        if not os.path.exists(self._get_comments_directory()):
-            os.makedirs(self._get_comments_directory())
-
         self._comments_lock = Lock()
         self._cached_comments: [Comment] or None = None
+        self._comment_map: {int: Comment} = {}
         self._comments_needs_update = True
+        # changes with every change to the comments, used as a key for cached comment fragments
+        self.comments_version = 0
 
     def add_language(self, language: str, url_name: str):
         if self.original:
@@ -67,55 +87,6 @@ class BlogPost:
             return self.original.get_languages()
         return self.languages
 
-    def _render_markdown(self):
-        content_html = markdown.markdown(self._content_md, extensions=['fenced_code', 'codehilite', 'extra'])
-        soup = bs4.BeautifulSoup(content_html, 'html.parser')
-
-        for img in soup.find_all('img'):
-            # skip images that have the 'no-open' class
-            if 'no-open' in img.get('class', []):
-                continue
-                
-            src = img.get('src')
-            if src is None:
-                continue
-
-            a_wrapper = soup.new_tag('a',
-                                     href=src,
-                                     target='_blank',
-                                     style='cursor: zoom-in;')
-            img.wrap(a_wrapper)
-
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href is None:
-                continue
-            if href.startswith('#'):
-                continue
-            link['target'] = '_blank'
-
-        footnote = soup.find(class_='footnote')
-        if footnote:
-            # turn the footnote div into a <details> element
-            details = soup.new_tag('details', **{'class': 'footnote'})
-
-            summary = soup.new_tag('summary', **{'class': 'footnote-summary'})
-            summary.string = 'Footnotes'
-
-            details.append(summary)
-            for child in list(footnote.children):
-                # ignore hr
-                if isinstance(child, bs4.element.Tag) and child.name == 'hr':
-                    continue
-                details.append(child.extract())
-            footnote.replace_with(details)
-
-
-        return str(soup)
-
-    def _get_comments_directory(self):
-        return os.path.join(blog_directory, 'comments', self.url_name)
-
     def _get_hash(self):
         digest = hashlib.md5(self.url_name.encode()).hexdigest()
         base64_hash = base64.b64encode(digest.encode()).decode()
@@ -126,99 +97,77 @@ class BlogPost:
         with self._comments_lock:
             self._comments_needs_update = True
 
-    def _load_comments_from_disk(self):
-        directory = self._get_comments_directory()
+    def _load_comments(self):
         comment_map: {int: Comment} = {}
 
-        for filename in os.listdir(directory):
-            if not filename.endswith('.json') or not os.path.isfile(os.path.join(directory, filename)):
-                continue
-
-            with open(os.path.join(directory, filename), encoding='utf-8', errors='ignore') as f:
-                try:
-                    data = json.load(f)
-                    comment_id = int(filename.split('.')[0])
-                    comment = Comment(**data, comment_id=comment_id)
-                    comment_map[comment_id] = comment
-                except (json.JSONDecodeError, TypeError) as e:
-                    print(f"Error loading comment from {filename}: {e}")
-                    continue
+        for data in get_comment_store().get_comments(self.url_name):
+            try:
+                comment_map[data["comment_id"]] = Comment(**data)
+            except TypeError as e:
+                print(f"Error loading comment {data['comment_id']} of {self.url_name}: {e}")
 
         for comment in comment_map.values():
             if comment.replies_to_id:
                 comment.replies_to = comment_map.get(comment.replies_to_id)
 
-        comments = list(comment_map.values())
-        comments.sort(key=lambda x: x.timestamp)
-        return comments
+        # the store already returns them sorted by timestamp
+        return list(comment_map.values()), comment_map
 
     def get_comments(self):
         with self._comments_lock:
             if self._comments_needs_update:
-                self._cached_comments = self._load_comments_from_disk()
+                self._cached_comments, self._comment_map = self._load_comments()
                 self._comments_needs_update = False
+                self.comments_version = next(_comments_versions)
         return self._cached_comments
 
     def get_comment(self, comment_id: int):
-        comments = self.get_comments()
-        return next((c for c in comments if c.comment_id == comment_id), None)
+        self.get_comments()
+        return self._comment_map.get(comment_id)
 
     def add_comment(self,
                     user_name: str, user_id: int, comment: str, replies_to: int = None,
                     platform: str = None, profile_picture: str = None, profile_url: str = None):
+        data = {
+            'user_name': user_name,
+            'user_id': user_id,
+            'comment': comment,
+            'timestamp': time.time(),
+            'replies_to_id': replies_to,
+            'platform': platform,
+            'profile_picture': profile_picture,
+            'profile_url': profile_url,
+        }
+        comment_id = get_comment_store().add_comment(self.url_name, **data)
+
+        # keep the cached thread up to date instead of reloading all of it on the next view
         with self._comments_lock:
-            comment_id = 0
-            directory = self._get_comments_directory()
-            for filename in os.listdir(directory):
-                if not filename.endswith('.json') or not os.path.isfile(os.path.join(directory, filename)):
-                    continue
-                comment_id = max(comment_id, int(filename.split('.')[0]))
-
-            comment_id += 1
-            with open(os.path.join(directory, f'{comment_id}.json'), 'w', encoding='utf-8') as f:
-                data = {
-                    'user_name': user_name,
-                    'user_id': user_id,
-                    'comment': comment,
-                    'timestamp': time.time(),
-                    'replies_to_id': replies_to,
-                    'platform': platform,
-                    'profile_picture': profile_picture,
-                    'profile_url': profile_url,
-                }
-                f.write(json.dumps(data, indent=4))
-
-        self.mark_comments_for_update()
+            if not self._comments_needs_update:
+                new_comment = Comment(**data, comment_id=comment_id)
+                if new_comment.replies_to_id:
+                    new_comment.replies_to = self._comment_map.get(new_comment.replies_to_id)
+                self._comment_map[comment_id] = new_comment
+                bisect.insort(self._cached_comments, new_comment, key=lambda x: x.timestamp)
+                self.comments_version = next(_comments_versions)
         return comment_id
 
-    def _modify_comment(self, comment_id: int, update_func):
-        comment_path = os.path.join(self._get_comments_directory(), f'{comment_id}.json')
-        if not os.path.exists(comment_path):
+    def _modify_comment(self, comment_id: int, **fields):
+        if not get_comment_store().update_comment(self.url_name, comment_id, **fields):
             return False
-        with open(comment_path, 'r+', encoding='utf-8') as f:
-            data = json.load(f)
-            update_func(data)
-            f.seek(0)
-            f.write(json.dumps(data, indent=4))
-            f.truncate()
-
-        self.mark_comments_for_update()
+
+        with self._comments_lock:
+            cached_comment = self._comment_map.get(comment_id)
+            if not self._comments_needs_update and cached_comment:
+                # replies point at the same object, so their quotes are updated as well
+                cached_comment.update(**fields)
+                self.comments_version = next(_comments_versions)
         return True
 
     def edit_comment(self, comment_id: int, new_content: str):
-        def update_func(data):
-            data['comment'] = new_content
-            data['edited_timestamp'] = int(time.time())
-
-        return self._modify_comment(comment_id, update_func)
+        return self._modify_comment(comment_id, comment=new_content, edited_timestamp=int(time.time()))
 
     def delete_comment(self, comment_id: int):
-        def update_func(data):
-            data['is_deleted'] = True
-            data['comment'] = ""
-            data['edited_timestamp'] = int(time.time())
-
-        return self._modify_comment(comment_id, update_func)
+        return self._modify_comment(comment_id, is_deleted=True, comment="", edited_timestamp=int(time.time()))
 
     def __repr__(self):
         return f'<BlogPost title="{self.title}" date="{self.date}" url_name="{self.url_name}">'
@@ -264,6 +213,12 @@ class Comment:
             short_comment = short_comment[:100] + "..."
         self.short_comment = short_comment
 
+    def update(self, comment: str, edited_timestamp: int = None, is_deleted: bool = None):
+        if is_deleted is not None:
+            self.is_deleted = is_deleted
+        self.edited_timestamp = edited_timestamp
+        self._process_comment(comment)
+
     @property
     def date_str(self):
         return helpers.timestamp_to_relative(self.timestamp)
@@ -277,19 +232,45 @@ class Comment:
 
 class BlogPostList(list):
     def __init__(self, *args: [BlogPost]):
-        if not all(isinstance(blog, BlogPost) for blog in args):
+        super().__init__()
+        self.languages: [str] = []
+        self.url_name_map: {str: BlogPost} = {}
+        self.hash_map: {str: BlogPost} = {}
+        self._by_language: {str: (BlogPost, ...)} = {}
+        self._newest: {str: BlogPost} = {}
+        # source path -> (file stamp, post), used to only re-parse changed files on reload
+        self.sources: {str: ((int, int), BlogPost)} = {}
+        # bumped every time the content changes, so derived caches know when to rebuild
+        self.version = 0
+        self.replace(args)
+
+    def replace(self, blog_posts: [BlogPost]):
+        if not all(isinstance(blog, BlogPost) for blog in blog_posts):
             raise ValueError("not a BlogPost")
-        sorted_blogs = sorted(args, key=lambda x: x.date, reverse=True)
-        super().__init__(sorted_blogs)
-        self.languages: [str] = [*{blog.language for blog in self}]
+        sorted_blogs = sorted(blog_posts, key=lambda x: x.date, reverse=True)
+        by_language: {str: [BlogPost]} = {}
+        for blog in sorted_blogs:
+            by_language.setdefault(blog.language, []).append(blog)
         # sort by amount of posts in each language
-        self.languages.sort(key=lambda x: len([blog for blog in self if blog.language == x]), reverse=True)
-
-        self.url_name_map: {str: BlogPost} = {blog.url_name: blog for blog in self}
-        self.hash_map: {str: BlogPost} = {blog.hash: blog for blog in self}
-
-    def get_by_language(self, language: str) -> [BlogPost]:
-        return [blog for blog in self if blog.language == language]
+        languages = sorted(by_language, key=lambda x: len(by_language[x]), reverse=True)
+        url_name_map = {blog.url_name: blog for blog in sorted_blogs}
+        hash_map = {blog.hash: blog for blog in sorted_blogs}
+
+        # everything is built up front and swapped in without any i/o in between,
+        # so no greenlet can observe a half-updated list
+        self[:] = sorted_blogs
+        self.languages = languages
+        self.url_name_map = url_name_map
+        self.hash_map = hash_map
+        self._by_language = {language: tuple(blogs) for language, blogs in by_language.items()}
+        self._newest = {language: blogs[0] for language, blogs in by_language.items()}
+        self.version += 1
+
+    def get_by_language(self, language: str) -> (BlogPost, ...):
+        return self._by_language.get(language, ())
+
+    def get_newest(self, language: str) -> BlogPost | None:
+        return self._newest.get(language)
 
     def get_by_url_name(self, url_name: str) -> BlogPost:
         return self.url_name_map.get(url_name)
@@ -300,52 +281,96 @@ class BlogPostList(list):
     def append(self, blog_post):
         if not isinstance(blog_post, BlogPost):
             raise ValueError("not a BlogPost")
-        super().append(blog_post)
-        self.languages.append(blog_post.language)
-        self.languages = list(set(self.languages))
-        self.languages.sort(key=lambda x: len([blog for blog in self if blog.language == x]), reverse=True)
-        self.url_name_map[blog_post.url_name] = blog_post
-        self.hash_map[blog_post.hash] = blog_post
-        self.sort(key=lambda x: x.date, reverse=True)
+        self.replace([*self, blog_post])
 
 
-def get_blog_posts():
-    blog_posts = BlogPostList()
+def _read_blog_file(path: str) -> dict:
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        metadata = {}
+
+        in_metadata = True
+        while in_metadata:
+            line = f.readline().strip()
+            if line.replace("-", "").strip() == "":
+                in_metadata = False
+            else:
+                try:
+                    key, value = line.split(":", 1)
+                except ValueError:
+                    raise ValueError(f"Invalid line: {line}")
+                key = key.strip().lower().replace(" ", "_").replace("-", "_")
+                value = value.strip()
+                metadata[key] = value
+
+        metadata["content"] = f.read()
+        metadata["url_name"] = os.path.splitext(os.path.basename(path))[0]
+    return metadata
+
+
+def _scan_blog_files() -> [str]:
+    paths = []
     for entry in *os.scandir(blog_directory), *os.scandir(os.path.join(blog_directory, 'translations')):
-        if not entry.name.endswith('.md') or not entry.is_file():
-            continue
-        with open(entry.path, encoding='utf-8', errors='ignore') as f:
-            url_name = os.path.splitext(entry.name)[0]
-
-            metadata = {}
-
-            in_metadata = True
-            while in_metadata:
-                line = f.readline().strip()
-                if line.replace("-", "").strip() == "":
-                    in_metadata = False
-                else:
-                    try:
-                        key, value = line.split(":", 1)
-                    except ValueError:
-                        raise ValueError(f"Invalid line: {line}")
-                    key = key.strip().lower().replace(" ", "_").replace("-", "_")
-                    value = value.strip()
-                    metadata[key] = value
-
-            metadata["content"] = f.read()
-            metadata["url_name"] = url_name
-            blog_post = BlogPost(**metadata)
-            if blog_post.original_url:
-                original = blog_posts.get_by_url_name(blog_post.original_url)
-                assert original
-                blog_post.original = original
-                original.add_language(blog_post.language, blog_post.url_name)
-            blog_posts.append(blog_post)
+        if entry.name.endswith('.md') and entry.is_file():
+            paths.append(entry.path)
+    return sorted(paths)
+
+
+def _link_translations(posts: [BlogPost]):
+    originals = {post.url_name: post for post in posts if not post.original_url}
+    # validate everything first, posts may be shared with the currently served list
+    for post in posts:
+        if post.original_url and post.original_url not in originals:
+            raise ValueError(f"{post.url_name} is a translation of unknown post {post.original_url}")
+
+    for post in originals.values():
+        post.languages = {post.language: post.url_name}
+    for post in posts:
+        if post.original_url:
+            post.original = originals[post.original_url]
+            post.original.add_language(post.language, post.url_name)
+
+
+def _load_posts(paths: [str], parallel: bool = False) -> {str: ((int, int), BlogPost)}:
+    # front-matter is cheap, so everything is parsed first and only the markdown rendering is done in parallel.
+    # the process pool is only used for the cold start, reloads run inside the gevent worker where starting
+    # processes is fragile, and only ever render the few posts that changed
+    stamps = [get_file_stamp(path) for path in paths]
+    metadata = [_read_blog_file(path) for path in paths]
+    rendered = render_all([data["content"] for data in metadata], parallel)
+    return {
+        path: (stamp, BlogPost(**data, content_html=content))
+        for path, stamp, data, content in zip(paths, stamps, metadata, rendered)
+    }
 
+
+def get_blog_posts():
+    sources = _load_posts(_scan_blog_files(), parallel=True)
+    posts = [post for _, post in sources.values()]
+    _link_translations(posts)
+    blog_posts = BlogPostList(*posts)
+    blog_posts.sources = sources
     return blog_posts
 
 
+def reload_blog_posts(blog_posts: BlogPostList) -> bool:
+    # only files that changed since the last load are parsed and rendered again
+    paths = _scan_blog_files()
+    changed = [
+        path for path in paths
+        if path not in blog_posts.sources or blog_posts.sources[path][0] != get_file_stamp(path)
+    ]
+    if not changed and len(paths) == len(blog_posts.sources):
+        return False
+
+    sources = {path: blog_posts.sources[path] for path in paths if path not in changed}
+    sources.update(_load_posts(changed))
+    posts = [post for _, post in sources.values()]
+    _link_translations(posts)
+    blog_posts.replace(posts)
+    blog_posts.sources = sources
+    return True
+
+
 def handle_comment(blog_id, request_, blogs):
     blog: BlogPost = next((b for b in blogs if b.url_name == blog_id), None)
     if not blog:
@@ -403,8 +428,6 @@ def modify_comment(blog_id, comment_id, request_, blogs: [BlogPost]):
     else:
         return
 
-    blog.mark_comments_for_update()
-
 
 def get_rss(blog_posts: [BlogPost], language):
     items = []
@@ -476,6 +499,45 @@ def get_news_sitemap(blog_posts: [BlogPost]):
     return sitemap_data
 
 
+def _get_last_modified(blog_posts: BlogPostList, posts: [BlogPost]) -> datetime | None:
+    stamps = {post.url_name: stamp for stamp, post in blog_posts.sources.values()}
+    newest = max((stamps[post.url_name][0] for post in posts if post.url_name in stamps), default=0)
+    return datetime.fromtimestamp(newest / 1e9, timezone.utc) if newest else None
+
+
+def _get_cached_feed(key: tuple, blog_posts: BlogPostList, build) -> PrecomputedResponse:
+    # feeds only change together with the posts, so they are rebuilt once per content version
+    cached = _feed_cache.get(key)
+    if cached is None or cached[0] != blog_posts.version:
+        cached = blog_posts.version, build()
+        _feed_cache[key] = cached
+    return cached[1]
+
+
+def get_rss_response(blog_posts: BlogPostList, language):
+    # unknown languages get the same feed as english, no need to cache a copy for every made up one
+    if language not in blog_posts.languages:
+        language = "en"
+    return _get_cached_feed(("rss", language), blog_posts, lambda: PrecomputedResponse(
+        get_rss(blog_posts, language),
+        mimetype="text/xml",
+        last_modified=_get_last_modified(
+            blog_posts, [post for post in blog_posts if post.language in (language, "en")]
+        ),
+    )).make_response()
+
+
+def get_news_sitemap_response(blog_posts: BlogPostList):
+    return _get_cached_feed(("news_sitemap",), blog_posts, lambda: PrecomputedResponse(
+        get_news_sitemap(blog_posts),
+        mimetype="text/xml",
+        last_modified=_get_last_modified(blog_posts, blog_posts),
+    )).make_response()
+
+
+_feed_cache: {tuple: (int, PrecomputedResponse)} = {}
+
+
 if __name__ == '__main__':
     for blog_post_ in get_blog_posts():
         print(blog_post_)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown
+import bs4
+import pygments
+
+import asset_manifest
+import images
+
+# only the pure markdown to html path lives here, the render pool imports this module in every worker,
+# so it must not pull in anything that loads databases, opens connections or registers exit handlers
+__all__ = ["render_markdown", "load_cached_render", "render_all", "get_file_stamp", "render_cache_directory"]
+
+render_cache_directory = os.path.join('cache', 'blog')
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'codehilite', 'extra']
+# bump this whenever _render_markdown changes its output, so stale cache entries are not reused
+RENDER_VERSION = 4
+
+
+def get_file_stamp(path: str) -> (int, int):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_render_key(content_md: str) -> str:
+    digest = hashlib.sha256()
+    for part in (
+            str(RENDER_VERSION), markdown.__version__, pygments.__version__, bs4.__version__,
+            *MARKDOWN_EXTENSIONS, content_md
+    ):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _get_render_cache_path(content_md: str) -> str:
+    return os.path.join(render_cache_directory, f'{_get_render_key(content_md)}.json')
+
+
+def load_cached_render(content_md: str) -> str | None:
+    try:
+        with open(_get_render_cache_path(content_md), encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # the output also depends on the images a post references, so the entry is only valid while they are unchanged
+    for path, stamp in cached["dependencies"].items():
+        try:
+            if list(get_file_stamp(path)) != stamp:
+                return None
+        except OSError:
+            return None
+    return cached["content"]
+
+
+def render_markdown(content_md: str) -> str:
+    # rendering is by far the slowest part of loading a post, so the html is cached on disk by source hash
+    content, dependencies = _render_markdown(content_md)
+    cache_path = _get_render_cache_path(content_md)
+    try:
+        os.makedirs(render_cache_directory, exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"content": content, "dependencies": dependencies}, f)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"Failed to write render cache: {e}")
+    return content
+
+
+def _is_monkey_patched() -> bool:
+    # gunicorn's gevent worker imports the app after patching, starting processes from there is fragile
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def render_all(sources: [str], parallel: bool) -> [str]:
+    rendered = [load_cached_render(source) for source in sources]
+    missing = [i for i, content in enumerate(rendered) if content is None]
+    if parallel and len(missing) > 1 and (os.cpu_count() or 1) > 1 and not _is_monkey_patched():
+        # spawn instead of fork, forking a process with gevent or running threads is asking for trouble
+        # the workers get the manifest of this process, so their asset links carry the same hashes
+        with ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=asset_manifest.load_manifest, initargs=(asset_manifest.get_manifest(),)
+        ) as pool:
+            for i, content in zip(missing, pool.map(render_markdown, [sources[i] for i in missing])):
+                rendered[i] = content
+    else:
+        for i in missing:
+            rendered[i] = render_markdown(sources[i])
+    return rendered
+
+
+def _add_image_variants(soup: bs4.BeautifulSoup, img: bs4.element.Tag, variants: {str: [(int, str)]}):
+    if "image/webp" not in variants:
+        return
+    img['srcset'] = ", ".join(f"{url} {width}w" for width, url in variants["image/webp"])
+    img['sizes'] = images.SIZES
+
+    if "image/avif" in variants:
+        picture = soup.new_tag('picture')
+        source = soup.new_tag(
+            'source',
+            type="image/avif",
+            srcset=", ".join(f"{url} {width}w" for width, url in variants["image/avif"]),
+            sizes=images.SIZES
+        )
+        img.wrap(picture)
+        img.insert_before(source)
+
+
+def _render_markdown(content_md: str) -> (str, {str: [int]}):
+    content_html = markdown.markdown(content_md, extensions=MARKDOWN_EXTENSIONS)
+    soup = bs4.BeautifulSoup(content_html, 'html.parser')
+
+    for img in soup.find_all('img'):
+        # skip images that have the 'no-open' class
+        if 'no-open' in img.get('class', []):
+            continue
+
+        src = img.get('src')
+        if src is None:
+            continue
+
+        a_wrapper = soup.new_tag('a',
+                                 href=src,
+                                 target='_blank',
+                                 style='cursor: zoom-in;')
+        img.wrap(a_wrapper)
+
+    # downscaled webp/avif variants, so phones do not have to download the full size screenshots
+    dependencies = {}
+    for img in soup.find_all('img'):
+        local_path = images.get_local_path(img.get('src') or "")
+        if local_path is None:
+            continue
+        dependencies[os.path.relpath(local_path)] = list(get_file_stamp(local_path))
+
+        src = img['src']
+        img['src'] = asset_manifest.fingerprint_url(src)
+        _add_image_variants(soup, img, images.get_variants(local_path, img['src']))
+        zoom_link = img.find_parent('a')
+        if zoom_link is not None and zoom_link.get('href') == src:
+            zoom_link['href'] = img['src']
+
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        if href is None:
+            continue
+        if href.startswith('#'):
+            continue
+        link['target'] = '_blank'
+
+    footnote = soup.find(class_='footnote')
+    if footnote:
+        # turn the footnote div into a <details> element
+        details = soup.new_tag('details', **{'class': 'footnote'})
+
+        summary = soup.new_tag('summary', **{'class': 'footnote-summary'})
+        summary.string = 'Footnotes'
+
+        details.append(summary)
+        for child in list(footnote.children):
+            # ignore hr
+            if isinstance(child, bs4.element.Tag) and child.name == 'hr':
+                continue
+            details.append(child.extract())
+        footnote.replace_with(details)
+
+    return str(soup), dependencies
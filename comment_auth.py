@@ -10,6 +10,8 @@ import urllib.parse
 from flask import request, redirect
 
 import const
+import http_client
+import mastodon_apps
 
 
 def get_gh_oauth_url(return_url=None):
@@ -26,26 +28,34 @@ def get_gh_oauth_url(return_url=None):
 
 
 def get_gh_access_token(code):
-    data = requests.post(
-        "https://github.com/login/oauth/access_token",
-        headers={"Accept": "application/json"},
-        data={
-            "client_id": const.GITHUB_CLIENT_ID,
-            "client_secret": const.GITHUB_CLIENT_SECRET,
-            "code": code,
-        },
-    )
-    if data.status_code != 200:
+    try:
+        data = http_client.post(
+            "https://github.com/login/oauth/access_token",
+            headers={"Accept": "application/json"},
+            data={
+                "client_id": const.GITHUB_CLIENT_ID,
+                "client_secret": const.GITHUB_CLIENT_SECRET,
+                "code": code,
+            },
+        )
+        if data.status_code != 200:
+            return None
+        return data.json().get("access_token")
+    except requests.RequestException:
         return None
-    return data.json().get("access_token")
 
 
 def get_gh_user_data(token):
-    data = requests.get(
-        "https://api.github.com/user",
-        headers={"Authorization": "token " + token},
-    )
-    return data.json()
+    try:
+        data = http_client.get(
+            "https://api.github.com/user",
+            headers={"Authorization": "token " + token},
+        )
+        if data.status_code != 200:
+            return None
+        return data.json()
+    except requests.RequestException:
+        return None
 
 
 def handle_gh_callback():
@@ -99,27 +109,35 @@ def get_discord_oauth_url(return_url=None):
 
 
 def get_discord_access_token(code):
-    data = requests.post(
-        "https://discord.com/api/v10/oauth2/token",
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": const.URL_BASE + "/discord/callback",
-        },
-        auth=(const.DISCORD_CLIENT_ID, const.DISCORD_CLIENT_SECRET),
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-    )
-    if data.status_code != 200:
+    try:
+        data = http_client.post(
+            "https://discord.com/api/v10/oauth2/token",
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": const.URL_BASE + "/discord/callback",
+            },
+            auth=(const.DISCORD_CLIENT_ID, const.DISCORD_CLIENT_SECRET),
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        if data.status_code != 200:
+            return None
+        return data.json().get("access_token")
+    except requests.RequestException:
         return None
-    return data.json().get("access_token")
 
 
 def get_discord_user_data(token):
-    data = requests.get(
-        "https://discord.com/api/v10/users/@me",
-        headers={"Authorization": "Bearer " + token},
-    )
-    return data.json()
+    try:
+        data = http_client.get(
+            "https://discord.com/api/v10/users/@me",
+            headers={"Authorization": "Bearer " + token},
+        )
+        if data.status_code != 200:
+            return None
+        return data.json()
+    except requests.RequestException:
+        return None
 
 
 def handle_discord_callback():
@@ -162,6 +180,7 @@ def handle_discord_callback():
 
 def get_mastodon_oauth_url(instance, return_url):
     try:
+        instance = (instance or "").strip().lower()
         # assert the instance is a valid domain
         assert re.match(
             r"^(?!-)(?:[a-zA-Z0-9](?:[a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$",
@@ -170,41 +189,16 @@ def get_mastodon_oauth_url(instance, return_url):
 
         redirect_url = const.URL_BASE + "/mastodon/callback/" + instance
 
-        # Default discovery endpoints
-        authorization_url = f"https://{instance}/oauth/authorize"
-        token_url = f"https://{instance}/oauth/token"
-
-        scope = "read:accounts"
-
-        # try to discover endpoints via .well-known
-        try:
-            req = requests.get(f"https://{instance}/.well-known/oauth-authorization-server", timeout=3)
-            if req.status_code == 200:
-                data = req.json()
-                allowed_scopes = data.get("scopes_supported", [])
-
-                # if profile is supported, use it for privacy purposes
-                if "profile" in allowed_scopes:
-                    scope = "profile"
+        # discovery and app registration only happen on the first login from an instance
+        app = mastodon_apps.get_app(instance, redirect_url)
+        if app is None:
+            raise LookupError("Instance could not be used")
 
-                authorization_url = data.get("authorization_endpoint", authorization_url)
-                token_url = data.get("token_endpoint", token_url)
-        except requests.RequestException:
-            pass
-
-        req = requests.post(
-            f"https://{instance}/api/v1/apps",
-            data={
-                "client_name": "lina's blog",
-                "redirect_uris": redirect_url,
-                "scopes": scope,
-                "website": const.URL_BASE
-            },
-            timeout=5
-        ).json()
-
-        client_id = req["client_id"]
-        client_secret = req["client_secret"]
+        client_id = app["client_id"]
+        client_secret = app["client_secret"]
+        authorization_url = app["authorization_url"]
+        token_url = app["token_url"]
+        scope = app["scope"]
 
         state_payload = {
             "ret": return_url,
@@ -226,15 +220,16 @@ def get_mastodon_oauth_url(instance, return_url):
         )
         return base_url
 
-    except (requests.RequestException, KeyError, AssertionError) as e:
+    except (requests.RequestException, KeyError, AssertionError, LookupError) as e:
         print(f"Mastodon Error: {e}")
         return ("/mastodon/instance_not_found?instance=" + urllib.parse.quote(instance) +
                 ("&return=" + urllib.parse.quote(return_url) if return_url else ""))
 
 
 def get_mastodon_access_token(code, client_id, client_secret, token_url, redirect_uri, scope):
+    # (token, error), error is the oauth error code the instance answered with, if any
     try:
-        data = requests.post(
+        data = http_client.post(
             token_url,
             data={
                 "grant_type": "authorization_code",
@@ -248,15 +243,18 @@ def get_mastodon_access_token(code, client_id, client_secret, token_url, redirec
         )
         if data.status_code != 200:
             print(f"Mastodon Token Error: {data.text}")
-            return None
-        return data.json().get("access_token")
-    except (requests.RequestException, KeyError):
-        return None
+            try:
+                return None, data.json().get("error")
+            except (ValueError, AttributeError):
+                return None, None
+        return data.json().get("access_token"), None
+    except (requests.RequestException, ValueError, KeyError, AttributeError):
+        return None, None
 
 
 def get_mastodon_user_data(instance, token):
     try:
-        data = requests.get(
+        data = http_client.get(
             f"https://{instance}/api/v1/accounts/verify_credentials",
             headers={"Authorization": "Bearer " + token},
             timeout=5
@@ -286,9 +284,12 @@ def handle_mastodon_callback(instance):
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
         return "Invalid state token. Please try logging in again.", 400
 
-    token = get_mastodon_access_token(code, client_id, client_secret, token_url, redirect_uri, scope)
+    token, error = get_mastodon_access_token(code, client_id, client_secret, token_url, redirect_uri, scope)
 
     if token is None:
+        if error == "invalid_client":
+            # the instance dropped the app, the next login registers a new one
+            mastodon_apps.forget_app(instance.lower())
         return "Invalid code or exchange failed", 400
 
     user_data = get_mastodon_user_data(instance, token)
@@ -348,25 +349,29 @@ def get_reddit_oauth_url(return_url=None):
 
 
 def get_reddit_access_token(code):
-    data = requests.post(
-        "https://www.reddit.com/api/v1/access_token",
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": const.URL_BASE + "/reddit/callback",
-        },
-        auth=(const.REDDIT_CLIENT_ID, const.REDDIT_CLIENT_SECRET),
-        headers={"User-Agent": "lina's blog"},
-    )
-    if data.status_code != 200:
-        print("Failed to get reddit access token:", data.status_code, data.text)
+    try:
+        data = http_client.post(
+            "https://www.reddit.com/api/v1/access_token",
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": const.URL_BASE + "/reddit/callback",
+            },
+            auth=(const.REDDIT_CLIENT_ID, const.REDDIT_CLIENT_SECRET),
+            headers={"User-Agent": "lina's blog"},
+        )
+        if data.status_code != 200:
+            print("Failed to get reddit access token:", data.status_code, data.text)
+            return None
+        return data.json().get("access_token")
+    except requests.RequestException as e:
+        print("Failed to get reddit access token:", e)
         return None
-    return data.json().get("access_token")
 
 
 def get_reddit_user_data(token):
     try:
-        data = requests.get(
+        data = http_client.get(
             "https://oauth.reddit.com/api/v1/me",
             headers={
                 "Authorization": "Bearer " + token,
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+__all__ = ["CommentStore", "COMMENT_FIELDS"]
+
+COMMENT_FIELDS = [
+    "user_name",
+    "user_id",
+    "platform",
+    "profile_picture",
+    "profile_url",
+    "comment",
+    "timestamp",
+    "edited_timestamp",
+    "is_deleted",
+    "replies_to_id",
+]
+
+# user_id deliberately has no type, github ids are ints while every other platform uses strings
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    post TEXT PRIMARY KEY,
+    last_comment_id INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS comments (
+    post TEXT NOT NULL,
+    comment_id INTEGER NOT NULL,
+    user_name TEXT,
+    user_id,
+    platform TEXT,
+    profile_picture TEXT,
+    profile_url TEXT,
+    comment TEXT NOT NULL DEFAULT '',
+    timestamp REAL NOT NULL,
+    edited_timestamp INTEGER,
+    is_deleted INTEGER NOT NULL DEFAULT 0,
+    replies_to_id INTEGER,
+    PRIMARY KEY (post, comment_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS comments_by_reply ON comments (post, replies_to_id);
+CREATE INDEX IF NOT EXISTS comments_by_time ON comments (post, timestamp);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+class CommentStore:
+    def __init__(self, path: str, legacy_directory: str = None):
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+        # the old one-file-per-comment directories are picked up on every start until one import went through
+        # completely, an import that failed halfway simply runs again
+        if legacy_directory and os.path.isdir(legacy_directory) and self._get_meta("legacy_imported") is None:
+            imported = self.import_json_comments(legacy_directory)
+            self._set_meta("legacy_imported", legacy_directory)
+            print(f"Imported {imported} comments from {legacy_directory}")
+
+    def _get_meta(self, key: str) -> str | None:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        data = {field: row[field] for field in COMMENT_FIELDS}
+        data["comment_id"] = row["comment_id"]
+        data["is_deleted"] = bool(data["is_deleted"])
+        return data
+
+    def _write(self, func):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def add_comment(self, post: str, **fields) -> int:
+        def insert():
+            self._db.execute("INSERT INTO posts (post) VALUES (?) ON CONFLICT DO NOTHING", (post,))
+            comment_id = self._db.execute(
+                "UPDATE posts SET last_comment_id = last_comment_id + 1, comment_count = comment_count + 1 "
+                "WHERE post = ? RETURNING last_comment_id",
+                (post,)
+            ).fetchone()[0]
+            self._insert(post, comment_id, fields)
+            return comment_id
+
+        return self._write(insert)
+
+    def _insert(self, post: str, comment_id: int, fields: dict):
+        columns = [field for field in COMMENT_FIELDS if field in fields]
+        self._db.execute(
+            f"INSERT OR IGNORE INTO comments (post, comment_id, {', '.join(columns)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(columns))})",
+            (post, comment_id, *(fields[field] for field in columns))
+        )
+
+    def update_comment(self, post: str, comment_id: int, **fields) -> bool:
+        columns = [field for field in COMMENT_FIELDS if field in fields]
+
+        def update():
+            row = self._db.execute(
+                "SELECT is_deleted FROM comments WHERE post = ? AND comment_id = ?", (post, comment_id)
+            ).fetchone()
+            if row is None:
+                return False
+            self._db.execute(
+                f"UPDATE comments SET {', '.join(f'{column} = ?' for column in columns)} "
+                f"WHERE post = ? AND comment_id = ?",
+                (*(fields[column] for column in columns), post, comment_id)
+            )
+            if fields.get("is_deleted") and not row["is_deleted"]:
+                self._db.execute("UPDATE posts SET comment_count = comment_count - 1 WHERE post = ?", (post,))
+            return True
+
+        return self._write(update)
+
+    def get_comments(self, post: str) -> [dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM comments WHERE post = ? ORDER BY timestamp", (post,)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def import_json_comments(self, directory: str) -> int:
+        # expects the old layout of <directory>/<post>/<comment id>.json, importing twice is a no-op
+        imported = 0
+        for post in sorted(os.listdir(directory)):
+            post_directory = os.path.join(directory, post)
+            if not os.path.isdir(post_directory):
+                continue
+
+            comments = {}
+            for filename in os.listdir(post_directory):
+                path = os.path.join(post_directory, filename)
+                if not filename.endswith('.json') or not os.path.isfile(path):
+                    continue
+                with open(path, encoding='utf-8', errors='ignore') as f:
+                    try:
+                        comments[int(filename.split('.')[0])] = json.load(f)
+                    except (json.JSONDecodeError, ValueError) as e:
+                        print(f"Error loading comment from {path}: {e}")
+
+            def import_post():
+                self._db.execute("INSERT INTO posts (post) VALUES (?) ON CONFLICT DO NOTHING", (post,))
+                for comment_id, data in comments.items():
+                    self._insert(post, comment_id, data)
+                self._db.execute(
+                    "UPDATE posts SET "
+                    "last_comment_id = (SELECT coalesce(max(comment_id), 0) FROM comments WHERE post = ?1), "
+                    "comment_count = (SELECT count(*) FROM comments WHERE post = ?1 AND NOT is_deleted) "
+                    "WHERE post = ?1",
+                    (post,)
+                )
+
+            self._write(import_post)
+            imported += len(comments)
+        return imported
+
+
+if __name__ == '__main__':
+    # usage: python comment_store.py [comments directory] [database]
+    legacy_directory_ = sys.argv[1] if len(sys.argv) > 1 else os.path.join('blog_posts', 'comments')
+    database_ = sys.argv[2] if len(sys.argv) > 2 else os.path.join('blog_posts', 'comments.sqlite3')
+    store = CommentStore(database_)
+    print(f"Imported {store.import_json_comments(legacy_directory_)} comments into {database_}")
@@ -0,0 +1,182 @@
+import gzip
+import mimetypes
+import os
+import sys
+import zlib
+
+import brotli
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+__all__ = [
+    "ENCODINGS", "compress_variants", "best_encoding", "precompress_directory", "send_precompressed", "init_app"
+]
+
+# in order of preference
+ENCODINGS = ["br", "gzip"]
+SUFFIXES = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+# everything else (images, videos, woff2, zip) is already compressed
+COMPRESSIBLE_EXTENSIONS = {".css", ".svg", ".html", ".txt", ".xml", ".json", ".js", ".ttf", ".otf", ".ico"}
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/xml", "application/xml", "application/json", "image/svg+xml"
+}
+# below this, the compression headers and the cpu time are not worth it
+MIN_COMPRESS_SIZE = 512
+# responses are compressed on the fly, so speed matters more than the last few percent
+DYNAMIC_BROTLI_QUALITY = 5
+DYNAMIC_GZIP_LEVEL = 6
+
+
+def compress_variants(data: bytes) -> {str: bytes}:
+    variants = {
+        "br": brotli.compress(data, quality=11),
+        "gzip": gzip.compress(data, compresslevel=9, mtime=0),
+    }
+    # tiny or already compressed bodies can end up larger, those are better sent as they are
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def best_encoding(available: [str]) -> str | None:
+    return request.accept_encodings.best_match([encoding for encoding in ENCODINGS if encoding in available])
+
+
+def _is_compressible(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def precompress_directory(directory: str) -> int:
+    # writes .br and .gz siblings next to every compressible file, so requests never have to compress anything
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not _is_compressible(name):
+                continue
+            path = os.path.join(root, name)
+            source_mtime = os.path.getmtime(path)
+            outdated = [
+                encoding for encoding, suffix in SUFFIXES.items()
+                if not os.path.exists(path + suffix) or os.path.getmtime(path + suffix) < source_mtime
+            ]
+            if not outdated or _incompressible.get(path) == source_mtime:
+                continue
+
+            with open(path, "rb") as f:
+                variants = compress_variants(f.read())
+            for encoding in outdated:
+                if encoding not in variants:
+                    # an older sibling would never be served again, but would be compressed again on every run
+                    try:
+                        os.remove(path + SUFFIXES[encoding])
+                    except OSError:
+                        pass
+                    _incompressible[path] = source_mtime
+                    continue
+                temp_path = f"{path}{SUFFIXES[encoding]}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(variants[encoding])
+                os.replace(temp_path, path + SUFFIXES[encoding])
+                written += 1
+    return written
+
+
+def send_precompressed(directory: str, filename: str):
+    if not _is_compressible(filename):
+        return send_from_directory(directory, filename)
+
+    source_path = safe_join(directory, filename)
+    try:
+        source_mtime = os.stat(source_path).st_mtime_ns if source_path else None
+    except OSError:
+        source_mtime = None
+
+    # a sibling older than its source is from before an edit, precompress_directory replaces it in the background
+    available = []
+    for encoding, suffix in SUFFIXES.items():
+        path = safe_join(directory, filename + suffix)
+        try:
+            if source_mtime is not None and path and os.stat(path).st_mtime_ns >= source_mtime:
+                available.append(encoding)
+        except OSError:
+            continue
+
+    encoding = best_encoding(available)
+    if encoding is None:
+        resp = send_from_directory(directory, filename)
+    else:
+        resp = send_from_directory(
+            directory, filename + SUFFIXES[encoding], mimetype=mimetypes.guess_type(filename)[0]
+        )
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
+def _compress_stream(chunks, encoding: str):
+    # one compressor per stream, flushed after every chunk, so each update still reaches the client right away
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=DYNAMIC_BROTLI_QUALITY)
+    else:
+        compressor = zlib.compressobj(DYNAMIC_GZIP_LEVEL, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if encoding == "br":
+                data = compressor.process(chunk) + compressor.flush()
+            else:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.finish() if encoding == "br" else compressor.flush()
+    finally:
+        # closing the original generator runs its cleanup, e.g. unsubscribing from the spotify events
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough or
+            "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES or
+            "no-transform" in response.headers.get("Cache-Control", "")):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = best_encoding(ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=DYNAMIC_BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=DYNAMIC_GZIP_LEVEL, mtime=0))
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+# path -> mtime of files where no encoding made them smaller, so the periodic refresh does not retry them
+_incompressible: {str: float} = {}
+
+
+def init_app(app):
+    # registered before every other after_request handler, flask runs them in reverse so this one is last
+    app.after_request(compress_response)
+
+
+if __name__ == '__main__':
+    # usage: python compression.py [directory], run as part of a deploy to skip the work on startup
+    directory_ = sys.argv[1] if len(sys.argv) > 1 else "assets"
+    print(f"Wrote {precompress_directory(directory_)} compressed files in {directory_}")
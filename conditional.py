@@ -0,0 +1,98 @@
+import hashlib
+
+import flask.wrappers
+from flask import make_response, request
+from functools import wraps
+
+from compression import ENCODINGS, best_encoding
+
+__all__ = ["etag", "etag_from"]
+
+# headers a 304 has to repeat so caches can update their stored copy
+NOT_MODIFIED_HEADERS = ["Cache-Control", "Content-Location", "Expires", "Vary"]
+
+
+def get_resp(resp) -> flask.wrappers.Response:
+    if not isinstance(resp, flask.wrappers.Response):
+        return make_response(resp)
+    return resp
+
+
+def get_matching_etag(tag: str) -> str | None:
+    if request.method not in ("GET", "HEAD") or not request.if_none_match:
+        return None
+    # compress_response suffixes the etag with the encoding it picks for this request
+    candidates = [tag]
+    encoding = best_encoding(ENCODINGS)
+    if encoding:
+        candidates.append(f"{tag}-{encoding}")
+    for candidate in candidates:
+        if request.if_none_match.contains_weak(candidate):
+            return candidate
+    return None
+
+
+def not_modified(tag: str, resp: flask.wrappers.Response = None, encoded: bool = False) -> flask.wrappers.Response:
+    # a new response object, views like the avatar proxies hand out the same cached one to everybody
+    not_modified_resp = flask.wrappers.Response(status=304)
+    if resp is not None:
+        for header in NOT_MODIFIED_HEADERS:
+            if header in resp.headers:
+                not_modified_resp.headers[header] = resp.headers[header]
+    # compress_response adds the Vary of the matching 200 only after this, and it skips 304s
+    if encoded:
+        not_modified_resp.vary.add("Accept-Encoding")
+    not_modified_resp.set_etag(tag)
+    return not_modified_resp
+
+
+def etag(f):
+    # strong etag from the response body, the view still runs but unchanged bodies are not sent again
+    @wraps(f)
+    def etag_wrapper(*args, **kwargs):
+        resp = get_resp(f(*args, **kwargs))
+        if resp.status_code != 200 or resp.is_streamed:
+            return resp
+
+        # files from send_from_directory already come with an etag, so do responses cached by lru_cache
+        tag, _ = resp.get_etag()
+        if tag is None:
+            if resp.direct_passthrough:
+                return resp
+            tag = hashlib.sha256(resp.get_data()).hexdigest()[:32]
+            resp.set_etag(tag)
+
+        matching_tag = get_matching_etag(tag)
+        if matching_tag is not None:
+            return not_modified(matching_tag, resp, encoded=matching_tag != tag)
+        return resp
+
+    return etag_wrapper
+
+
+def etag_from(get_version, cache_control: str = None):
+    # strong etag from a version that changes whenever the body does, a 304 skips the view entirely
+    # so the Cache-Control the view would have set has to be passed in
+    def decorator(f):
+        @wraps(f)
+        def etag_from_wrapper(*args, **kwargs):
+            version = get_version(*args, **kwargs)
+            if version is None:
+                return f(*args, **kwargs)
+
+            tag = hashlib.sha256(str(version).encode("utf-8")).hexdigest()[:32]
+            matching_tag = get_matching_etag(tag)
+            if matching_tag is not None:
+                resp = not_modified(matching_tag, encoded=matching_tag != tag)
+                if cache_control:
+                    resp.headers["Cache-Control"] = cache_control
+                return resp
+
+            resp = get_resp(f(*args, **kwargs))
+            if resp.status_code == 200:
+                resp.set_etag(tag)
+            return resp
+
+        return etag_from_wrapper
+
+    return decorator
@@ -5,6 +5,8 @@ dotenv.load_dotenv()
 
 
 IP_INFO_API_KEY = os.environ.get("IPINFO_API_KEY")
+# optional csv dump of ip ranges, see ip_ranges.py
+IP_DATABASE_PATH = os.environ.get("IP_DATABASE_PATH")
 TOR_HOSTNAME = os.environ.get("TOR_HOSTNAME")
 DISCORD_ID = int(os.environ.get("DISCORD_ID"))
 DISCORD_INVITE = os.environ.get("DISCORD_INVITE")
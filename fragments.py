@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+
+from flask import render_template
+
+import const
+from helpers import format_iso_date, generate_proxy_url
+
+__all__ = ["FragmentCache", "render_post_content", "render_discord_invite", "render_comment_list"]
+
+# relative comment dates ("5 minutes ago") are only re-rendered once per bucket
+RELATIVE_TIME_BUCKET = 60
+# anything older than this is shown as a plain date, which never changes
+RELATIVE_TIME_LIMIT = 60 * 60 * 24 * 7
+
+
+class FragmentCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: tuple, render) -> str:
+        # keys carry the version of everything the fragment depends on, so outdated entries are never hit again
+        # and simply fall out of the lru
+        fragment = self._entries.get(key)
+        if fragment is None:
+            fragment = render()
+            self._entries[key] = fragment
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return fragment
+
+
+def render_post_content(blog, blogs_version: int) -> str:
+    return _cache.get(("post", blog.url_name, blogs_version), lambda: render_template(
+        "partials/blog_post_content.html",
+        blog=blog,
+        date_text=format_iso_date(blog.date),
+        xmr_address=const.XMR_DONATION_ADDRESS,
+        btc_address=const.BTC_DONATION_ADDRESS,
+    ))
+
+
+def render_discord_invite(discord_server_info: dict) -> str:
+    key = ("discord_invite", *(discord_server_info.get(field) for field in ("name", "online", "members")))
+    return _cache.get(key, lambda: render_template(
+        "partials/discord_invite.html",
+        discord_server_info=discord_server_info,
+        discord_invite_url=const.DISCORD_INVITE,
+    ))
+
+
+def render_comment_list(blog, user_data) -> str:
+    now = time.time()
+    bucket = int(now // RELATIVE_TIME_BUCKET)
+    post_path = f"/blog/{blog.url_name}"
+    fragments = []
+    for comment in blog.get_comments():
+        is_owner = bool(
+            user_data and comment.user_id == user_data.user_id and comment.platform == user_data.platform
+        )
+        changed = max(comment.timestamp, comment.edited_timestamp or 0)
+        key = (
+            "comment", blog.url_name, comment.comment_id, blog.comments_version,
+            bucket if now - changed < RELATIVE_TIME_LIMIT else None,
+            user_data is not None, is_owner,
+        )
+        fragments.append(_cache.get(key, lambda: render_template(
+            "partials/comment.html",
+            comment=comment,
+            logged_in=user_data is not None,
+            is_owner=is_owner,
+            post_path=post_path,
+            generate_proxy_url=generate_proxy_url,
+        )))
+    return "".join(fragments)
+
+
+_cache = FragmentCache(max_entries=4096)
@@ -1,45 +1,88 @@
 import hashlib
 import hmac
 import json
+import queue
 import random
 import re
 import time
 import urllib.parse
 from datetime import datetime
-from functools import lru_cache
 
-import pytz
 import requests
 import unicodedata
 from dateutil.relativedelta import relativedelta
 from flask import send_from_directory, request
 
+import asset_manifest
 import const
+import http_client
+import ip_info
+from lanyard import LanyardSubscription
+from singleflight import SingleFlight
+
+DISCORD_STATUSES = ("online", "idle", "dnd", "offline")
 
 
 def get_discord_status():
     try:
-        req = requests.get("https://api.lanyard.rest/v1/users/" + str(const.DISCORD_ID)).json()
+        req = http_client.get("https://api.lanyard.rest/v1/users/" + str(const.DISCORD_ID)).json()
         return req.get("data", {}).get("discord_status", "")
     except requests.exceptions.RequestException:
         return None
 
 
-def get_server_status():
+def build_discord_status_css(status: str | None) -> str:
+    # later rules win, so every update simply overrides the previous one
+    if status not in DISCORD_STATUSES:
+        return "<style>#discord_status { visibility: hidden; }</style>"
+    return (
+        "<style>#discord_status { visibility: visible; } #discord_status .status { display: none; } "
+        f"#discord_status .status-{status} {{ display: inline; }}</style>"
+    )
+
+
+def discord_status_events(start_html: str):
+    # same no-js trick as spotify.event_reader, the page stays open and every status change appends a <style>
+    listener = discord_presence.add_listener()
+    try:
+        yield start_html
+        yield build_discord_status_css(discord_presence.discord_status)
+        while True:
+            try:
+                yield build_discord_status_css(listener.get(timeout=10))
+            except queue.Empty:
+                # dropped for falling behind, the client reconnects and starts from the current status again
+                if not discord_presence.has_listener(listener):
+                    break
+                yield " \n"  # keep connection alive
+    finally:
+        discord_presence.remove_listener(listener)
+
+
+def get_server_status(previous: dict = None):
+    # previous is the last result, its icon is reused as long as the icon hash stays the same
+    previous = previous or {}
     try:
         # extract the invite code from the URL
         match = const.DISCORD_INVITE.split("/")[-1]
-        req = requests.get(f"https://discord.com/api/v9/invites/{match}", timeout=5)
+        req = http_client.get(f"https://discord.com/api/v9/invites/{match}", timeout=5)
         req.raise_for_status()
         resp = req.json()
         icon_hash = resp.get("profile", {}).get("icon_hash", "")
-        try:
-            icon_bytes = requests.get(f"https://cdn.discordapp.com/icons/{const.SERVER_ID}/{icon_hash}.png").content
-        except requests.exceptions.RequestException:
-            icon_bytes = None
+        if icon_hash and icon_hash == previous.get("icon_hash"):
+            icon_bytes = previous.get("icon_bytes")
+        else:
+            try:
+                icon_req = http_client.get(f"https://cdn.discordapp.com/icons/{const.SERVER_ID}/{icon_hash}.png")
+                # an error page must not be served (and kept) as the icon, without a hash it is fetched again
+                icon_req.raise_for_status()
+                icon_bytes = icon_req.content
+            except requests.exceptions.RequestException:
+                icon_bytes = None
         return {
             "name": resp.get("profile", {}).get("name", ""),
             "icon_bytes": icon_bytes,
+            "icon_hash": icon_hash if icon_bytes else None,
             "members": resp.get("profile", {}).get("member_count", 0),
             "online": resp.get("profile", {}).get("online_count", 0),
         }
@@ -53,15 +96,11 @@ def get_age():
     return relativedelta(today, birthday).years
 
 
-@lru_cache(maxsize=32)
 def get_time_at_ip(ip: str) -> str | None:
-    try:
-        req = requests.get(f"https://ipinfo.io/{ip}?token={const.IP_INFO_API_KEY}").json()
-        timezone = req.get("timezone", "UTC")
-        time_there = datetime.now(pytz.timezone(timezone))
-        return time_there.strftime("%I:%M")
-    except requests.exceptions.RequestException:
+    time_there = ip_info.get_local_time(ip)
+    if time_there is None:
         return None
+    return time_there.strftime("%I:%M")
 
 
 def fishlogic():
@@ -85,9 +124,9 @@ def format_iso_date(iso_timestamp):
 
 
 def show_notification(blogs, request):
-    if len(blogs) == 0:
+    blog = blogs.get_newest("en")
+    if blog is None:
         return None
-    blog = blogs.get_by_language("en")[0]
     cookie = request.cookies.get("last_read")
     if cookie == blog.url_name:
         return None
@@ -172,7 +211,7 @@ def is_safe_url(target):
 
 def generate_proxy_url(remote_url):
     if not remote_url:
-        return "/assets/mastodon.png"
+        return asset_manifest.asset_url("mastodon.png")
 
     signature = hmac.new(
         const.JWT_SECRET.encode('utf-8'),
@@ -184,31 +223,44 @@ def generate_proxy_url(remote_url):
     return f"/mastodon/profile_image?url={encoded_url}&sig={signature}"
 
 
-@lru_cache(maxsize=100)
 def fetch_remote_image(url_arg):
+    # (None, None) if there is no usable image at the url, connection errors and 5xx responses are raised
+    # so that callers caching the result can tell a missing image from an upstream that is down.
+    # concurrent fetches of the same url share one request
     try:
-        if not url_arg.startswith("http://") and not url_arg.startswith("https://"):
-            return None, None
+        return _image_fetches.do(url_arg, lambda: _fetch_remote_image(url_arg), timeout=http_client.time_left())
+    except TimeoutError:
+        # waiting for another request's fetch counts against this request's deadline as well
+        raise http_client.DeadlineExceeded(f"No time left waiting for {url_arg}")
 
-        with requests.get(url_arg, timeout=5, stream=True) as req:
+
+def _fetch_remote_image(url_arg):
+    if not url_arg.startswith("http://") and not url_arg.startswith("https://"):
+        return None, None
+
+    with http_client.get(url_arg, timeout=5, stream=True) as req:
+        if req.status_code >= 500:
             req.raise_for_status()
+        if req.status_code != 200:
+            return None, None
 
-            # check Content-Type
-            content_type = req.headers.get("Content-Type", "")
-            if not content_type.startswith("image/"):
-                return None, None
+        # check Content-Type
+        content_type = req.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"):
+            return None, None
+
+        content_length = req.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > 10 * 1024 * 1024:
+            return None, None
 
-            content_length = req.headers.get("Content-Length")
-            if content_length and int(content_length) > 10 * 1024 * 1024:
+        content = bytearray()
+        for chunk in req.iter_content(chunk_size=8192):
+            content.extend(chunk)
+            if len(content) > 10 * 1024 * 1024:
                 return None, None
 
-            content = bytearray()
-            for chunk in req.iter_content(chunk_size=8192):
-                content.extend(chunk)
-                if len(content) > 10 * 1024 * 1024:
-                    return None, None
+        return bytes(content), content_type
 
-            return bytes(content), content_type
 
-    except Exception as e:
-        return None, None
\ No newline at end of file
+_image_fetches = SingleFlight()
+discord_presence = LanyardSubscription(const.DISCORD_ID)
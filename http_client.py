@@ -0,0 +1,229 @@
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import TimeoutError as Urllib3Timeout
+from urllib3.util.retry import Retry
+
+__all__ = [
+    "get", "post", "request", "get_host_stats", "deadline", "time_left", "init_app", "DeadlineExceeded",
+    "CircuitOpen", "DEFAULT_TIMEOUT", "REQUEST_BUDGET",
+]
+
+# (connect, read) in seconds, calls can still pass their own timeout
+DEFAULT_TIMEOUT = (3.05, 10)
+# total time every outbound call made while handling one incoming request may take together
+REQUEST_BUDGET = 8
+
+# how many hosts keep a connection pool around (mastodon instances are arbitrary) and how many connections each
+POOL_HOSTS = 32
+POOL_SIZE = 8
+
+# only idempotent methods are retried, a retried POST could create a second token or comment
+RETRY = Retry(
+    total=2,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+    raise_on_status=False,
+)
+
+# a host that failed this many times in a row is not asked again until a background probe gets an answer
+FAILURE_THRESHOLD = 5
+PROBE_INTERVAL = 30
+PROBE_TIMEOUT = (3.05, 5)
+# hosts that stay down (e.g. a mistyped mastodon instance) are not probed forever, after this many probes
+# one real request every PROBE_INTERVAL is let through instead and closes the circuit if it works
+PROBE_ATTEMPTS = 10
+# mastodon instances are whatever users type in, only the most recently used hosts keep their stats
+MAX_TRACKED_HOSTS = 256
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    pass
+
+
+def _create_session() -> requests.Session:
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=RETRY)
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    return new_session
+
+
+@contextmanager
+def deadline(seconds: float):
+    # every call inside gets at most what is left of the budget, nested deadlines can only shorten it
+    previous = getattr(_local, "deadline", None)
+    new_deadline = time.monotonic() + seconds
+    _local.deadline = new_deadline if previous is None else min(previous, new_deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def time_left() -> float | None:
+    # seconds left of the current deadline, None outside of one. for waiting on anything that is not a request
+    current_deadline = getattr(_local, "deadline", None)
+    if current_deadline is None:
+        return None
+    return max(0.0, current_deadline - time.monotonic())
+
+
+def _apply_deadline(timeout, url: str):
+    # (timeout, clamped), clamped tells whether the deadline shortened the timeout
+    remaining = time_left()
+    if remaining is None:
+        return timeout, False
+    if remaining <= 0:
+        raise DeadlineExceeded(f"No time left for {url}")
+    # the read timeout is per socket read rather than for the whole response, it is still the closest requests has
+    parts = timeout if isinstance(timeout, tuple) else (timeout,)
+    clamped = tuple(remaining if part is None else min(part, remaining) for part in parts)
+    return (clamped if isinstance(timeout, tuple) else clamped[0]), clamped != parts
+
+
+def _is_timeout(error: requests.RequestException) -> bool:
+    # once the retries are used up, requests reports a timeout as a ConnectionError wrapping urllib3's error
+    if isinstance(error, requests.Timeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, Urllib3Timeout)
+
+
+def _probe(scheme: str, host: str):
+    # host includes the port, if the url had one
+    # any answer below 500 means the host is back, until then it keeps failing fast
+    for _ in range(PROBE_ATTEMPTS):
+        time.sleep(PROBE_INTERVAL)
+        try:
+            status_code = session.head(f"{scheme}://{host}/", timeout=PROBE_TIMEOUT).status_code
+        except requests.RequestException:
+            continue
+        if status_code < 500:
+            with _stats_lock:
+                stats = _host_stats.get(host)
+                if stats is not None:
+                    stats["consecutive_failures"] = 0
+                    stats["circuit_open"] = False
+                    stats["probing"] = False
+            print(f"Circuit for {host} closed again")
+            return
+
+    with _stats_lock:
+        stats = _host_stats.get(host)
+        if stats is not None:
+            stats["probing"] = False
+            stats["retry_at"] = time.monotonic()
+    print(f"Gave up probing {host}, the next request tries it again")
+
+
+def _get_stats(host: str) -> dict:
+    # called with the lock held
+    stats = _host_stats.get(host)
+    if stats is None:
+        stats = _host_stats[host] = {
+            "requests": 0, "failures": 0, "seconds": 0.0, "consecutive_failures": 0, "circuit_open": False,
+            "probing": False, "retry_at": 0.0,
+        }
+        if len(_host_stats) > MAX_TRACKED_HOSTS:
+            # the probe thread of a host still looks its stats up, those are kept
+            oldest = next((name for name, old in _host_stats.items() if not old["probing"]), None)
+            if oldest is not None:
+                del _host_stats[oldest]
+    else:
+        _host_stats.move_to_end(host)
+    return stats
+
+
+def _count(host: str, scheme: str, start: float, failed: bool | None):
+    # failed is None if the outcome says nothing about the host, e.g. a timeout only hit because the incoming
+    # request ran out of budget. those neither open nor close the circuit
+    with _stats_lock:
+        stats = _get_stats(host)
+        stats["requests"] += 1
+        stats["seconds"] += time.monotonic() - start
+        if failed is None:
+            return
+        stats["failures"] += failed
+        stats["consecutive_failures"] = stats["consecutive_failures"] + 1 if failed else 0
+        if not failed:
+            # a request let through after the probes gave up worked
+            stats["circuit_open"] = False
+        should_open = not stats["circuit_open"] and stats["consecutive_failures"] >= FAILURE_THRESHOLD
+        if should_open:
+            stats["circuit_open"] = True
+            stats["probing"] = True
+    if should_open:
+        print(f"Circuit for {host} opened after {FAILURE_THRESHOLD} failures in a row")
+        threading.Thread(target=_probe, args=(scheme, host), daemon=True).start()
+
+
+def _check_circuit(host: str):
+    with _stats_lock:
+        stats = _host_stats.get(host)
+        if stats is None or not stats["circuit_open"]:
+            return
+        if not stats["probing"] and time.monotonic() >= stats["retry_at"]:
+            # this request is the probe, everybody else keeps failing fast until it is done
+            stats["retry_at"] = time.monotonic() + PROBE_INTERVAL
+            return
+    raise CircuitOpen(f"{host} is failing, not trying again until it recovers")
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    parsed_url = urllib.parse.urlsplit(url)
+    # without any credentials, but with the port, which may well be a different service than the default one
+    host = parsed_url.netloc.rpartition("@")[2].lower()
+    _check_circuit(host)
+    kwargs["timeout"], clamped = _apply_deadline(kwargs.get("timeout", DEFAULT_TIMEOUT), url)
+
+    start = time.monotonic()
+    try:
+        resp = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        _count(host, parsed_url.scheme, start, None if clamped and _is_timeout(e) else True)
+        raise
+    _count(host, parsed_url.scheme, start, resp.status_code >= 500)
+    return resp
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get_host_stats() -> {str: dict}:
+    with _stats_lock:
+        return {host: dict(stats) for host, stats in _host_stats.items()}
+
+
+def init_app(app, budget: float = REQUEST_BUDGET):
+    # each request gets its own deadline, background threads only have the per-call timeouts
+    def start_deadline():
+        _local.deadline = time.monotonic() + budget
+
+    def clear_deadline(_):
+        _local.deadline = None
+
+    app.before_request(start_deadline)
+    app.teardown_request(clear_deadline)
+
+
+session = _create_session()
+# gunicorn runs gevent workers, threading.local is patched to be greenlet local there
+_local = threading.local()
+_stats_lock = threading.Lock()
+_host_stats: OrderedDict[str, dict] = OrderedDict()
@@ -0,0 +1,84 @@
+import hashlib
+import os
+
+from PIL import Image, UnidentifiedImageError, features
+
+__all__ = ["get_local_path", "get_variants", "image_cache_directory", "SIZES"]
+
+image_cache_directory = os.path.join('cache', 'images')
+assets_directory = 'assets'
+
+# the blog content column is 760px wide, 1520 covers it on 2x screens
+VARIANT_WIDTHS = [480, 760, 1520]
+SIZES = "(max-width: 800px) 100vw, 760px"
+
+# mimetype -> (pillow format, file extension, save options), in order of preference
+FORMATS = {
+    "image/avif": ("AVIF", "avif", {"quality": 55, "speed": 8}),
+    "image/webp": ("WEBP", "webp", {"quality": 80, "method": 6}),
+}
+if not features.check("avif"):
+    del FORMATS["image/avif"]
+
+
+def get_local_path(src: str) -> str | None:
+    if not src.startswith("/assets/"):
+        return None
+    base = os.path.abspath(assets_directory)
+    path = os.path.abspath(os.path.join(base, src[len("/assets/"):].split("?")[0]))
+    if os.path.commonpath([base, path]) != base or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _get_variant_name(source_hash: str, width: int, extension: str) -> str:
+    return f"{source_hash}-{width}.{extension}"
+
+
+def get_variants(path: str, original_url: str) -> {str: [(int, str)]}:
+    # returns {mimetype: [(width, url), ...]}, generating whatever variants are not on disk yet. only widths below
+    # the source are generated, original_url is listed at the full width so large screens still get the original
+    with open(path, "rb") as f:
+        source_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    try:
+        with Image.open(path) as image:
+            # animations would lose every frame but the first, svgs are not supported by pillow anyway
+            if getattr(image, "n_frames", 1) > 1:
+                return {}
+            widths = [width for width in VARIANT_WIDTHS if width < image.width]
+            if not widths:
+                return {}
+
+            variants = {}
+            for mimetype, (image_format, extension, options) in FORMATS.items():
+                variants[mimetype] = []
+                for width in widths:
+                    name = _get_variant_name(source_hash, width, extension)
+                    variant_path = os.path.join(image_cache_directory, name)
+                    if not os.path.exists(variant_path):
+                        _save_variant(image, width, variant_path, image_format, options)
+                    variants[mimetype].append((width, f"/assets/variants/{name}"))
+                variants[mimetype].append((image.width, original_url))
+            return variants
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError) as e:
+        # one broken image must not keep the post (or the whole blog) from loading, it is shown without variants
+        print(f"Failed to generate image variants for {path}: {e}")
+        return {}
+
+
+def _save_variant(image: Image.Image, width: int, variant_path: str, image_format: str, options: dict):
+    variant = image.copy()
+    if variant.mode not in ("RGB", "RGBA"):
+        variant = variant.convert("RGBA")
+    variant.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+
+    os.makedirs(image_cache_directory, exist_ok=True)
+    temp_path = f"{variant_path}.{os.getpid()}.tmp"
+    try:
+        variant.save(temp_path, format=image_format, **options)
+        os.replace(temp_path, variant_path)
+    except (OSError, ValueError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,154 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+import requests
+
+import const
+import http_client
+from ip_ranges import IpRangeDatabase
+from singleflight import SingleFlight
+
+__all__ = ["IpInfoCache", "get_ip_info", "get_local_time", "ip_cache_path"]
+
+# jammingen cleans up every file directly inside cache/, so this lives in its own directory
+ip_cache_path = os.path.join('cache', 'ip', 'ipinfo.json')
+
+# an address rarely moves to another timezone or isp, a day is plenty fresh
+IP_INFO_TTL = 60 * 60 * 24
+MAX_ENTRIES = 4096
+# new visitors keep adding entries, the file is rewritten at most this often
+SAVE_INTERVAL = 60
+
+
+class IpInfoCache:
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # ip -> (fetched_at, raw ipinfo record), oldest use first
+        self._entries: OrderedDict = OrderedDict()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        now = time.time()
+        for ip, (fetched_at, record) in entries.items():
+            if now - fetched_at < self.ttl:
+                self._entries[ip] = (fetched_at, record)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, ip: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= self.ttl:
+                del self._entries[ip]
+                return None
+            self._entries.move_to_end(ip)
+            return entry[1]
+
+    def put(self, ip: str, record: dict):
+        with self._lock:
+            self._entries[ip] = (time.time(), record)
+            self._entries.move_to_end(ip)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        if time.monotonic() - self._saved_at >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Failed to save ip info cache: {e}")
+
+
+def _fetch_ip_info(ip: str) -> dict | None:
+    try:
+        req = http_client.get(f"https://ipinfo.io/{ip}?token={const.IP_INFO_API_KEY}")
+        req.raise_for_status()
+        record = req.json()
+    except (requests.exceptions.RequestException, json.JSONDecodeError):
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def _get_remote_ip_info(ip: str) -> dict | None:
+    record = _cache.get(ip)
+    if record is None:
+        record = _lookups.do(ip, lambda: _fetch_ip_info(ip))
+        if record is not None:
+            _cache.put(ip, record)
+    return record
+
+
+def get_ip_info(ip: str, fields: tuple = None) -> dict | None:
+    # the raw ipinfo record (timezone, country, org, loc, ...), None if nothing is known about the address
+    # ipinfo is only asked when the local database is missing one of the wanted fields (or any, without fields)
+    local_record = _local_database.lookup(ip) if _local_database else None
+    if local_record and fields and all(local_record.get(field) for field in fields):
+        return local_record
+
+    record = _get_remote_ip_info(ip)
+    if local_record:
+        return {**(record or {}), **local_record}
+    return record
+
+
+def get_local_time(ip: str) -> datetime | None:
+    # only the timezone is cached, the time itself is worked out fresh on every call
+    record = get_ip_info(ip, fields=("timezone",))
+    if record is None:
+        return None
+    try:
+        timezone = pytz.timezone(record.get("timezone") or "UTC")
+    except pytz.UnknownTimeZoneError:
+        timezone = pytz.utc
+    return datetime.now(timezone)
+
+
+_cache = IpInfoCache(ip_cache_path, ttl=IP_INFO_TTL, max_entries=MAX_ENTRIES)
+atexit.register(_cache.save)
+_lookups = SingleFlight()
+
+
+def _load_local_database(path: str | None) -> IpRangeDatabase | None:
+    if not path:
+        return None
+    start = time.perf_counter()
+    try:
+        database = IpRangeDatabase.from_csv(path)
+    except (OSError, ValueError) as e:
+        print(f"Failed to load ip database {path}: {e}")
+        return None
+    print(f"Loaded {len(database)} ip ranges from {path} in {time.perf_counter() - start:.2f}s")
+    return database
+
+
+_local_database = _load_local_database(const.IP_DATABASE_PATH)
@@ -0,0 +1,141 @@
+import csv
+import ipaddress
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+import pytz
+
+__all__ = ["IpRangeDatabase", "FIELD_ALIASES"]
+
+# column names used by the common free dumps (db-ip, ip2location lite, iptoasn, ...) -> ipinfo field names
+FIELD_ALIASES = {
+    "start_ip": "start", "ip_from": "start", "range_start": "start", "ip_start": "start", "start": "start",
+    "end_ip": "end", "ip_to": "end", "range_end": "end", "ip_end": "end", "end": "end",
+    "country": "country", "country_code": "country", "country_iso_code": "country",
+    "region": "region", "region_name": "region", "subdivision": "region", "state": "region",
+    "city": "city", "city_name": "city",
+    "postal": "postal", "zip_code": "postal", "postal_code": "postal",
+    "timezone": "timezone", "time_zone": "timezone",
+    "org": "org", "as_description": "org", "isp": "org",
+    "latitude": "latitude", "longitude": "longitude",
+}
+
+
+def _parse_address(value: str) -> ipaddress.IPv4Address | ipaddress.IPv6Address:
+    # dumps either use dotted addresses or plain integers
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return ipaddress.IPv4Address(number) if number < 2 ** 32 else ipaddress.IPv6Address(number)
+    return ipaddress.ip_address(value)
+
+
+class _Ranges:
+    # sorted, non-overlapping ranges of one address family, values are indexes into IpRangeDatabase.records
+    def __init__(self, typecode: str):
+        self.starts = array(typecode) if typecode else []
+        self.ends = array(typecode) if typecode else []
+        self.values = array("I")
+
+    def add(self, start: int, end: int, value: int):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.values.append(value)
+
+    def sort(self):
+        if all(a <= b for a, b in zip(self.starts, self.starts[1:])):
+            return
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        for name in ("starts", "ends", "values"):
+            column = getattr(self, name)
+            sorted_column = [column[i] for i in order]
+            setattr(self, name, array(column.typecode, sorted_column) if isinstance(column, array) else sorted_column)
+
+    def find(self, address: int) -> int | None:
+        i = bisect_right(self.starts, address) - 1
+        if i < 0 or address > self.ends[i]:
+            return None
+        return self.values[i]
+
+
+class IpRangeDatabase:
+    # an offline ip -> {country, timezone, ...} lookup, the ranges are kept in flat integer arrays and every
+    # distinct combination of fields is only stored once, so even a few million ranges stay small
+    def __init__(self):
+        self.records: [dict] = []
+        self._record_ids: {tuple: int} = {}
+        # ipv6 addresses do not fit into an array, those ranges use plain lists
+        self._ipv4 = _Ranges("I")
+        self._ipv6 = _Ranges("")
+
+    def __len__(self):
+        return len(self._ipv4.starts) + len(self._ipv6.starts)
+
+    def add_range(self, start: str, end: str, record: dict):
+        start_address, end_address = _parse_address(start), _parse_address(end)
+        if start_address.version != end_address.version:
+            raise ValueError(f"Range {start} - {end} mixes ipv4 and ipv6")
+        key = tuple(sorted(record.items()))
+        record_id = self._record_ids.get(key)
+        if record_id is None:
+            record_id = self._record_ids[key] = len(self.records)
+            self.records.append(record)
+        ranges = self._ipv4 if start_address.version == 4 else self._ipv6
+        ranges.add(int(start_address), int(end_address), record_id)
+
+    @classmethod
+    def from_csv(cls, path: str) -> "IpRangeDatabase":
+        # expects a header row, columns that are not in FIELD_ALIASES are ignored
+        database = cls()
+        with open(path, newline='', encoding='utf-8', errors='replace') as f:
+            reader = csv.reader(f)
+            header = [FIELD_ALIASES.get(column.strip().lower()) for column in next(reader)]
+            if "start" not in header or "end" not in header:
+                raise ValueError(f"{path} has no start/end column")
+            for row in reader:
+                fields = {
+                    name: value.strip() for name, value in zip(header, row) if name and value.strip() not in ("", "-")
+                }
+                start, end = fields.pop("start", None), fields.pop("end", None)
+                if start is None or end is None:
+                    continue
+                # ipinfo reports the location as a single "lat,lon" field
+                latitude, longitude = fields.pop("latitude", None), fields.pop("longitude", None)
+                if latitude and longitude:
+                    fields["loc"] = f"{latitude},{longitude}"
+                # ip2location's time_zone column is a utc offset like "+10:00", only iana names are usable. without
+                # one the field counts as missing and ipinfo is asked instead
+                if fields.get("timezone") not in pytz.all_timezones_set:
+                    fields.pop("timezone", None)
+                try:
+                    database.add_range(start, end, fields)
+                except ValueError:
+                    continue
+        database._ipv4.sort()
+        database._ipv6.sort()
+        return database
+
+    def lookup(self, ip: str) -> dict | None:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        ranges = self._ipv4 if address.version == 4 else self._ipv6
+        record_id = ranges.find(int(address))
+        return None if record_id is None else self.records[record_id]
+
+
+if __name__ == '__main__':
+    # usage: python ip_ranges.py <database.csv> <ip> [ip ...]
+    load_start = time.perf_counter()
+    database_ = IpRangeDatabase.from_csv(sys.argv[1])
+    print(f"Loaded {len(database_)} ranges with {len(database_.records)} distinct records "
+          f"in {time.perf_counter() - load_start:.2f}s")
+    for ip_ in sys.argv[2:]:
+        lookup_start = time.perf_counter()
+        result = database_.lookup(ip_)
+        print(f"{ip_}: {result} ({(time.perf_counter() - lookup_start) * 1e6:.1f}µs)")
@@ -5,9 +5,9 @@ from hashlib import sha256
 from user_agents import parse
 from PIL import Image, ImageDraw, WebPImagePlugin
 from flask import Response, request, redirect
-import requests
 
-import const
+import ip_info
+from singleflight import SingleFlight
 
 # Cache duration in seconds
 CACHE_DURATION = 60 * 60  # 1 hour
@@ -23,8 +23,7 @@ def get_ip_info(ip: str):
         "postal": "",
         "timezone": "UTC/UTC",
     }
-    req = requests.get(f"https://ipinfo.io/{ip}?token={const.IP_INFO_API_KEY}")
-    empty.update(req.json())  # Ensure that all keys are present
+    empty.update(ip_info.get_ip_info(ip, fields=tuple(empty)) or {})  # Ensure that all keys are present
     return empty
 
 
@@ -53,8 +52,19 @@ def render():
         if os.path.getmtime(cache_file) > time.time() - CACHE_DURATION:
             return Response(open(cache_file, "rb"), mimetype="image/webp")
 
+    # concurrent requests from the same visitor wait for the first render instead of rendering it again
+    _renders.do(cache_file, lambda: _render_image(cache_file, ip, useragent_parsed))
+
+    # Return the image
+    return Response(open(cache_file, "rb"), mimetype="image/webp")
+
+
+def _render_image(cache_file: str, ip: str, useragent_parsed):
     # Delete files older than 1 hour
     for file in os.listdir("cache"):
+        # other caches live in subdirectories of cache/
+        if not os.path.isfile(f"cache/{file}"):
+            continue
         if os.path.getmtime(f"cache/{file}") < time.time() - CACHE_DURATION:
             os.remove(f"cache/{file}")
 
@@ -70,11 +80,11 @@ def render():
         "Country: " + data["country"],
         data["region"],
         data["city"],
-        "ISP: " + data["org"].split(" ")[1],
+        "ISP: " + data["org"].split(" ", 1)[-1],
         "Lat: " + data["loc"].split(",")[0],
         "Lon: " + data["loc"].split(",")[1],
         "Postal: " + data["postal"],
-        "Timezone: " + data["timezone"].split("/")[1],
+        "Timezone: " + data["timezone"].split("/")[-1],
     ]
 
     # Strip out special characters
@@ -121,5 +131,5 @@ def render():
         cache_file, save_all=True, append_images=frames[1:], duration=jamming.info["duration"], loop=0
     )
 
-    # Return the image
-    return Response(open(cache_file, "rb"), mimetype="image/webp")
+
+_renders = SingleFlight()
@@ -0,0 +1,188 @@
+import json
+import queue
+import threading
+import time
+
+import websocket
+
+__all__ = ["LanyardSubscription", "LocalLanyardSocket", "LANYARD_SOCKET_URL"]
+
+LANYARD_SOCKET_URL = "wss://api.lanyard.rest/socket"
+CONNECT_TIMEOUT = 10
+# waits between reconnects, doubled after every failed attempt
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+
+# https://github.com/Phineas/lanyard#socket-docs
+OP_EVENT = 0
+OP_HELLO = 1
+OP_INITIALIZE = 2
+OP_HEARTBEAT = 3
+PRESENCE_EVENTS = {"INIT_STATE", "PRESENCE_UPDATE"}
+
+
+def _connect_websocket():
+    socket = websocket.create_connection(LANYARD_SOCKET_URL, timeout=CONNECT_TIMEOUT)
+    # presence updates can be hours apart, a dead connection shows up when sending the heartbeat fails
+    socket.settimeout(None)
+    return socket
+
+
+class LanyardSubscription:
+    # one websocket to lanyard for the whole process, every page showing the status listens to this
+    # instead of polling. connect returns anything with recv/send/close, LocalLanyardSocket works without network
+    def __init__(self, user_id, connect=None):
+        self.user_id = str(user_id)
+        self._connect = connect or _connect_websocket
+        self.presence: dict | None = None
+        self.connected = False
+        self._started = False
+        self._listeners: set[queue.Queue] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def discord_status(self) -> str | None:
+        presence = self.presence
+        return None if presence is None else presence.get("discord_status", "")
+
+    def update(self, presence: dict | None) -> bool:
+        # also used by the polling fallback while the socket is down, returns whether the status changed
+        with self._lock:
+            old_status = self.discord_status
+            self.presence = presence
+            status = self.discord_status
+            if status == old_status:
+                return False
+            for listener in list(self._listeners):
+                try:
+                    listener.put_nowait(status)
+                except queue.Full:
+                    # a client that stopped reading, its stream ends once it notices
+                    self._listeners.discard(listener)
+        return True
+
+    def add_listener(self, maxsize: int = 20) -> queue.Queue:
+        listener = queue.Queue(maxsize=maxsize)
+        with self._lock:
+            self._listeners.add(listener)
+        return listener
+
+    def remove_listener(self, listener: queue.Queue):
+        with self._lock:
+            self._listeners.discard(listener)
+
+    def has_listener(self, listener: queue.Queue) -> bool:
+        with self._lock:
+            return listener in self._listeners
+
+    def listener_count(self) -> int:
+        with self._lock:
+            return len(self._listeners)
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._run, daemon=True, name="lanyard").start()
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                socket = self._connect()
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"Failed to connect to lanyard: {e}")
+            else:
+                try:
+                    self._listen(socket)
+                except (websocket.WebSocketException, OSError, ValueError, KeyError, TypeError) as e:
+                    print(f"Lanyard connection lost: {e}")
+                finally:
+                    was_connected = self.connected
+                    self.connected = False
+                    socket.close()
+                # the connection worked, so the next attempt starts with the short delay again
+                if was_connected:
+                    delay = RECONNECT_DELAY
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _listen(self, socket):
+        hello = json.loads(socket.recv())
+        if hello.get("op") != OP_HELLO:
+            raise ValueError(f"Expected hello, got {hello}")
+        heartbeat_interval = hello["d"]["heartbeat_interval"] / 1000
+
+        socket.send(json.dumps({"op": OP_INITIALIZE, "d": {"subscribe_to_id": self.user_id}}))
+
+        send_lock = threading.Lock()
+        closed = threading.Event()
+
+        def heartbeat():
+            while not closed.wait(heartbeat_interval):
+                try:
+                    with send_lock:
+                        socket.send(json.dumps({"op": OP_HEARTBEAT}))
+                except (websocket.WebSocketException, OSError):
+                    # unblocks the recv below
+                    socket.close()
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True, name="lanyard-heartbeat").start()
+        try:
+            while True:
+                message = socket.recv()
+                if not message:
+                    raise websocket.WebSocketConnectionClosedException("Lanyard closed the connection")
+                data = json.loads(message)
+                if data.get("op") == OP_EVENT and data.get("t") in PRESENCE_EVENTS:
+                    self.connected = True
+                    self.update(data["d"])
+        finally:
+            closed.set()
+
+
+class LocalLanyardSocket:
+    # speaks the lanyard socket protocol in-process, for tests and for running without network access:
+    # LanyardSubscription(user_id, connect=LocalLanyardSocket().connect)
+    heartbeat_interval_ms = 30000
+
+    def __init__(self, presence: dict = None):
+        self.presence = presence or {"discord_status": "online"}
+        self.subscribed_to: str | None = None
+        self.heartbeats = 0
+        self.closed = True
+        self._incoming = queue.Queue()
+
+    def _push(self, op: int, d=None, t: str = None):
+        self._incoming.put(json.dumps({"op": op, "d": d, "t": t}))
+
+    def connect(self):
+        self.closed = False
+        self._incoming = queue.Queue()
+        self._push(OP_HELLO, {"heartbeat_interval": self.heartbeat_interval_ms})
+        return self
+
+    def recv(self) -> str:
+        if self.closed:
+            return ""
+        return self._incoming.get()
+
+    def send(self, message: str):
+        if self.closed:
+            raise websocket.WebSocketConnectionClosedException("Socket is already closed")
+        data = json.loads(message)
+        if data["op"] == OP_INITIALIZE:
+            self.subscribed_to = data["d"]["subscribe_to_id"]
+            self._push(OP_EVENT, self.presence, "INIT_STATE")
+        elif data["op"] == OP_HEARTBEAT:
+            self.heartbeats += 1
+
+    def close(self):
+        self.closed = True
+        self._incoming.put("")
+
+    def push_presence(self, presence: dict):
+        self.presence = presence
+        if not self.closed:
+            self._push(OP_EVENT, presence, "PRESENCE_UPDATE")
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+import const
+import http_client
+from singleflight import SingleFlight
+
+__all__ = ["MastodonAppCache", "get_app", "forget_app", "apps_cache_path"]
+
+apps_cache_path = os.path.join('cache', 'mastodon', 'apps.json')
+
+# registrations do not expire on the instance side, this only makes sure changed endpoints are picked up eventually
+APP_TTL = 60 * 60 * 24 * 30
+# instances that are down or not mastodon at all go straight to the not found page for a while
+FAILURE_TTL = 60 * 10
+
+
+class MastodonAppCache:
+    # instance -> (expires, app), where app is None for instances that failed. failures only live in memory,
+    # anyone can type in any instance. only a handful of instances are ever used, so the whole file is rewritten
+    # on every change
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: {str: (float, dict | None)} = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        now = time.time()
+        self._entries = {
+            instance: (expires, app) for instance, (expires, app) in entries.items() if app and expires > now
+        }
+
+    def _save(self):
+        # called with the lock held
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({instance: entry for instance, entry in self._entries.items() if entry[1]}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Failed to save mastodon app cache: {e}")
+
+    def get(self, instance: str) -> (bool, dict | None):
+        # (found, app), a cached failure is (True, None)
+        with self._lock:
+            entry = self._entries.get(instance)
+        if entry is None or entry[0] <= time.time():
+            return False, None
+        return True, entry[1]
+
+    def put(self, instance: str, app: dict | None):
+        now = time.time()
+        with self._lock:
+            for expired in [name for name, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[expired]
+            self._entries[instance] = (now + (APP_TTL if app else FAILURE_TTL), app)
+            if app:
+                self._save()
+
+    def forget(self, instance: str):
+        with self._lock:
+            entry = self._entries.pop(instance, None)
+            if entry is not None and entry[1]:
+                self._save()
+
+
+def _discover_endpoints(instance: str) -> dict:
+    # Default discovery endpoints
+    endpoints = {
+        "authorization_url": f"https://{instance}/oauth/authorize",
+        "token_url": f"https://{instance}/oauth/token",
+        "scope": "read:accounts",
+    }
+
+    # try to discover endpoints via .well-known
+    try:
+        req = http_client.get(f"https://{instance}/.well-known/oauth-authorization-server", timeout=3)
+        if req.status_code == 200:
+            data = req.json()
+            allowed_scopes = data.get("scopes_supported", [])
+
+            # if profile is supported, use it for privacy purposes
+            if "profile" in allowed_scopes:
+                endpoints["scope"] = "profile"
+
+            endpoints["authorization_url"] = data.get("authorization_endpoint", endpoints["authorization_url"])
+            endpoints["token_url"] = data.get("token_endpoint", endpoints["token_url"])
+    except (requests.RequestException, AttributeError):
+        pass
+    return endpoints
+
+
+def _register_app(instance: str, redirect_url: str) -> dict | None:
+    # None if the instance definitely cannot be used (a 4xx or an answer that is not an app), which is cached.
+    # timeouts, connection errors, 5xx and 429 are raised and not cached, the next login simply tries again
+    app = _discover_endpoints(instance)
+    req = http_client.post(
+        f"https://{instance}/api/v1/apps",
+        data={
+            "client_name": "lina's blog",
+            "redirect_uris": redirect_url,
+            "scopes": app["scope"],
+            "website": const.URL_BASE
+        },
+        timeout=5
+    )
+    if req.status_code >= 500 or req.status_code == 429:
+        req.raise_for_status()
+    if req.status_code >= 400:
+        print(f"Mastodon Error: {instance} answered {req.status_code}")
+        return None
+    try:
+        data = req.json()
+        app["client_id"] = data["client_id"]
+        app["client_secret"] = data["client_secret"]
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Mastodon Error: {e}")
+        return None
+    app["redirect_url"] = redirect_url
+    return app
+
+
+def get_app(instance: str, redirect_url: str) -> dict | None:
+    # endpoints, scope and client credentials for the instance, registering an app there only on the first login.
+    # None if the instance could not be used, transient errors are raised as requests.RequestException
+    found, app = _cache.get(instance)
+    if found and (app is None or app["redirect_url"] == redirect_url):
+        return app
+
+    def register():
+        new_app = _register_app(instance, redirect_url)
+        _cache.put(instance, new_app)
+        return new_app
+
+    return _registrations.do(instance, register)
+
+
+def forget_app(instance: str):
+    # for when the instance no longer accepts the stored credentials, the next login registers a new app
+    _cache.forget(instance)
+
+
+_cache = MastodonAppCache(apps_cache_path)
+_registrations = SingleFlight()
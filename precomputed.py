@@ -0,0 +1,61 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+
+import flask
+from flask import request
+
+from compression import compress_variants, best_encoding
+
+__all__ = ["PrecomputedResponse", "constant", "render_constant_responses"]
+
+
+class PrecomputedResponse:
+    def __init__(self, body: bytes | str, mimetype: str, last_modified: datetime = None, headers: dict = None):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.last_modified = last_modified
+        self.headers = headers or {}
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.variants = compress_variants(self.body)
+
+    def make_response(self) -> flask.Response:
+        encoding = best_encoding(list(self.variants))
+        resp = flask.Response(self.variants[encoding] if encoding else self.body, mimetype=self.mimetype)
+        resp.headers.update(self.headers)
+        resp.headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        # every encoding is a different byte sequence, so each one needs its own strong etag
+        resp.set_etag(f"{self.etag}-{encoding}" if encoding else self.etag)
+        if self.last_modified:
+            resp.last_modified = self.last_modified
+        return resp.make_conditional(request)
+
+
+def _precompute(view) -> PrecomputedResponse:
+    resp = flask.make_response(view())
+    headers = {key: value for key, value in resp.headers.items() if key not in ("Content-Type", "Content-Length")}
+    return PrecomputedResponse(resp.get_data(), resp.mimetype, headers=headers)
+
+
+def constant(f):
+    # for views whose output can not change while the process is running, they only run once
+    @wraps(f)
+    def constant_wrapper():
+        if constant_wrapper.precomputed is None:
+            constant_wrapper.precomputed = _precompute(f)
+        return constant_wrapper.precomputed.make_response()
+
+    constant_wrapper.precomputed = None
+    _constant_views.append(constant_wrapper)
+    return constant_wrapper
+
+
+def render_constant_responses(app: flask.Flask):
+    with app.test_request_context():
+        for view in _constant_views:
+            view.precomputed = _precompute(view.__wrapped__)
+
+
+_constant_views = []
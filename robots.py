@@ -4,7 +4,7 @@ from functools import wraps
 
 import const
 
-__all__ = ["noarchive", "index", "follow", "noindex", "nofollow", "robot_friendly"]
+__all__ = ["noarchive", "index", "follow", "noindex", "nofollow", "robot_friendly", "update_sitemaps"]
 
 
 def get_resp(resp) -> flask.wrappers.Response:
@@ -64,9 +64,8 @@ def robot_friendly(app: flask.app.Flask, blogs, extra_sitemaps=None):
         "sitemap.txt",
         *extra_sitemaps
     ]
-    sitemap_urls = gen_urllist(app, blogs)
     robots_txt = gen_robots_txt(sitemaps, app)
-    site_map_txt = "\n".join([const.URL_BASE + url for url in sitemap_urls])
+    update_sitemaps(app, blogs)
 
     @app.route("/robots.txt")
     def robots_txt_route():
@@ -74,16 +73,26 @@ def robot_friendly(app: flask.app.Flask, blogs, extra_sitemaps=None):
 
     @app.route("/sitemap.txt")
     def sitemap_txt():
-        return flask.Response(site_map_txt, mimetype="text/plain")
+        return flask.Response(_sitemap["txt"], mimetype="text/plain")
 
     @app.route("/sitemap.xml")
     def sitemap_xml_route():
         return flask.Response(
-            flask.render_template("sitemap.xml", urls=sitemap_urls, url_base=const.URL_BASE),
+            flask.render_template("sitemap.xml", urls=_sitemap["urls"], url_base=const.URL_BASE),
             mimetype="text/xml"
         )
 
 
+def update_sitemaps(app: flask.app.Flask, blogs):
+    sitemap_urls = gen_urllist(app, blogs)
+    # swapped as a whole so requests never see the url list and the text version out of sync
+    global _sitemap
+    _sitemap = {
+        "urls": sitemap_urls,
+        "txt": "\n".join([const.URL_BASE + url for url in sitemap_urls]),
+    }
+
+
 def gen_robots_txt(sitemaps: [str], app: flask.app.Flask):
     # Initialize the lines for the robots.txt content
     lines = ["User-agent: *"]
@@ -128,3 +137,4 @@ def gen_urllist(app, blogs):
 
 
 _disallowed_endpoints: set[str] = set()
+_sitemap: dict = {"urls": [], "txt": ""}
@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+__all__ = ["Task", "Scheduler"]
+
+
+@dataclass
+class Task:
+    # func returns whether it changed anything and raises if it failed, failures back off exponentially
+    name: str
+    func: callable
+    interval: float
+    # fraction of the interval every delay is randomly moved by, so tasks do not line up
+    jitter: float = 0.1
+    max_backoff: float = 600
+    runs: int = 0
+    changes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_success: float | None = None
+    last_duration: float | None = None
+    last_error: str | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def next_delay(self) -> float:
+        delay = min(self.interval * 2 ** self.consecutive_failures, max(self.max_backoff, self.interval))
+        return max(0.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def run_once(self):
+        start = time.monotonic()
+        try:
+            changed = self.func()
+        except Exception as e:
+            with self._lock:
+                self.runs += 1
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_duration = time.monotonic() - start
+                self.last_error = f"{type(e).__name__}: {e}"
+            print(f"Task {self.name} failed ({self.consecutive_failures} in a row): {e}")
+            return
+        with self._lock:
+            self.runs += 1
+            self.changes += bool(changed)
+            self.consecutive_failures = 0
+            self.last_success = time.time()
+            self.last_duration = time.monotonic() - start
+            self.last_error = None
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "runs": self.runs,
+                "changes": self.changes,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "last_success": self.last_success,
+                "last_duration": self.last_duration,
+                "last_error": self.last_error,
+            }
+
+
+class Scheduler:
+    # every task runs in its own thread (a greenlet under gunicorn's gevent worker), so a slow upstream only
+    # delays its own task
+    def __init__(self):
+        self.tasks: {str: Task} = {}
+
+    def add(self, name: str, func, interval: float, **options) -> Task:
+        task = self.tasks[name] = Task(name, func, interval, **options)
+        return task
+
+    def _loop(self, task: Task, initial_delay: float):
+        time.sleep(initial_delay)
+        while True:
+            task.run_once()
+            time.sleep(task.next_delay())
+
+    def start(self, run_immediately: bool = True):
+        for task in self.tasks.values():
+            initial_delay = 0 if run_immediately else task.next_delay()
+            threading.Thread(target=self._loop, args=(task, initial_delay), daemon=True, name=task.name).start()
+
+    def get_stats(self) -> {str: dict}:
+        return {name: task.get_stats() for name, task in self.tasks.items()}
@@ -0,0 +1,101 @@
+import math
+import re
+
+import bs4
+import snowballstemmer
+
+__all__ = ["SearchIndex", "update_indexes", "search"]
+
+STEMMERS = {
+    "en": "english",
+    "de": "german",
+}
+
+# how much a match in each field counts compared to one in the post body
+FIELD_WEIGHTS = {
+    "title": 3,
+    "summary": 2,
+    "text": 1,
+}
+
+# the usual BM25 parameters
+K1 = 1.2
+B = 0.75
+
+MAX_QUERY_TERMS = 16
+
+word_pattern = re.compile(r"\w+")
+
+
+class SearchIndex:
+    def __init__(self, posts, language: str):
+        self.posts = list(posts)
+        self._stemmer = snowballstemmer.stemmer(STEMMERS.get(language, "english"))
+        self._stem_cache: {str: str} = {}
+
+        postings: {str: {int: float}} = {}
+        doc_lengths = []
+        for doc, post in enumerate(self.posts):
+            fields = {
+                "title": post.title,
+                "summary": post.summary,
+                "text": bs4.BeautifulSoup(post.content, 'html.parser').get_text(" "),
+            }
+            length = 0
+            for field, text in fields.items():
+                weight = FIELD_WEIGHTS[field]
+                for term in self.tokenize(text):
+                    term_postings = postings.setdefault(term, {})
+                    term_postings[doc] = term_postings.get(doc, 0) + weight
+                    length += weight
+            doc_lengths.append(length)
+
+        average_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0
+        # everything that does not depend on the query is folded into the postings up front,
+        # so a lookup only has to add up precomputed scores
+        self._postings: {str: [(int, float)]} = {}
+        for term, term_postings in postings.items():
+            idf = math.log(1 + (len(self.posts) - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            self._postings[term] = [
+                (doc, idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * doc_lengths[doc] / average_length)))
+                for doc, tf in term_postings.items()
+            ]
+
+    def _stem(self, word: str) -> str:
+        stem = self._stem_cache.get(word)
+        if stem is None:
+            stem = self._stemmer.stemWord(word)
+            if len(self._stem_cache) < 10000:
+                self._stem_cache[word] = stem
+        return stem
+
+    def tokenize(self, text: str) -> [str]:
+        return [self._stem(word) for word in word_pattern.findall(text.lower())]
+
+    def search(self, query: str, limit: int = 20) -> list:
+        scores: {int: float} = {}
+        for term in set(self.tokenize(query)[:MAX_QUERY_TERMS]):
+            for doc, score in self._postings.get(term, ()):
+                scores[doc] = scores.get(doc, 0) + score
+        ranked = sorted(scores, key=lambda doc: scores[doc], reverse=True)
+        return [self.posts[doc] for doc in ranked[:limit]]
+
+
+def update_indexes(blog_posts):
+    global _indexes
+    _indexes = blog_posts.version, {
+        language: SearchIndex(blog_posts.get_by_language(language), language)
+        for language in blog_posts.languages
+    }
+
+
+def search(blog_posts, query: str, language: str) -> list:
+    if _indexes[0] != blog_posts.version:
+        update_indexes(blog_posts)
+    index = _indexes[1].get(language)
+    if index is None:
+        return []
+    return index.search(query)
+
+
+_indexes: (int, {str: SearchIndex}) = (-1, {})
@@ -0,0 +1,50 @@
+import threading
+
+__all__ = ["SingleFlight"]
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    # concurrent callers asking for the same key wait for the first one instead of fetching it again,
+    # everybody gets the same result, or the same exception if the first caller failed.
+    # nothing is kept once the call is done, caching the result is up to the caller
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: {object: _Call} = {}
+
+    def do(self, key, fn, timeout: float = None):
+        # timeout only applies to waiting for another caller, a waiter that runs out of time raises TimeoutError
+        # while the first caller carries on
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"Gave up waiting for {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
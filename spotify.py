@@ -10,7 +10,9 @@ import requests
 from gevent import queue, lock
 from playwright.sync_api import sync_playwright
 
+import asset_manifest
 import const
+import http_client
 from helpers import css_escape
 
 shared_event_queues = set()
@@ -52,7 +54,7 @@ def get_access_token(token_type: Literal["main", "fallback"]):
 
     auth = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
     try:
-        response = requests.post(
+        response = http_client.post(
             "https://accounts.spotify.com/api/token",
             data={"grant_type": "refresh_token", "refresh_token": refresh_token},
             headers={"Authorization": f"Basic {auth}", "Content-Type": "application/x-www-form-urlencoded"}
@@ -124,7 +126,7 @@ def fetch_lyrics(track_id: str, retried=False) -> dict[float, int] | None:
             return None
 
     try:
-        req = requests.get(
+        req = http_client.get(
             f"https://spclient.wg.spotify.com/color-lyrics/v2/track/{track_id}",
             headers={
                 "Authorization": f"Bearer {account_bearer}",
@@ -166,7 +168,7 @@ def fetch_lyrics(track_id: str, retried=False) -> dict[float, int] | None:
 
 def get_spotify_status(token: str) -> dict | None:
     try:
-        response = requests.get(
+        response = http_client.get(
             "https://api.spotify.com/v1/me/player/currently-playing",
             headers={"Authorization": f"Bearer {token}"}
         )
@@ -203,7 +205,7 @@ def build_not_playing_css() -> str:
 
 def build_static_css(state: SpotifyState) -> str:
     return f"""
-    <a href="{state.song_url}" class="open-song" target="_blank"><div><img src="/assets/open.svg" alt="Open"></div></a>
+    <a href="{state.song_url}" class="open-song" target="_blank"><div><img src="{asset_manifest.asset_url('open.svg')}" alt="Open"></div></a>
     <style>
         .open-song {{ display: block; }}
         .notification-content {{ display: flex; }}
@@ -373,7 +375,7 @@ def spotify_status_updater():
                 # update cover bytes if urt changed
                 if current_state.cover_url != last_cover_url:
                     try:
-                        cover_bytes = requests.get(current_state.cover_url).content
+                        cover_bytes = http_client.get(current_state.cover_url).content
                         last_cover_url = current_state.cover_url
                     except requests.RequestException:
                         cover_bytes = None